@@ -6,8 +6,13 @@ from urllib.parse import urlparse
 # The host and port on which the application server is started.
 # localhost should be used when deploying for the local machine only,
 # otherwise use a static IP address, 0.0.0.0 or a domain name.
+#
+# The port, the data `prefix` and the MongoDB database can also be set with
+# the REGISTRY_PORT, REGISTRY_PREFIX and REGISTRY_DB environment variables,
+# eg. to run a second instance from the same checkout (see "Mirroring" in
+# the README).
 host = 'localhost'
-port = 8000
+port = int(os.environ.get('REGISTRY_PORT', 8000))
 
 # The visible url of the application. This url is used for example in
 # the mail sent to verify your email address after registering an account.
@@ -18,17 +23,84 @@ server_name = urlparse(visible_url).netloc
 debug = True
 
 # The prefix under which the application data is stored.
-prefix = os.path.expanduser('~/nodepy-registry-data')
+prefix = os.environ.get('REGISTRY_PREFIX') or os.path.expanduser('~/nodepy-registry-data')
+
+# The directory of the content-addressed file store.
+blob_prefix = os.path.join(prefix, '.blobs')
+
+# How files are served from /api/download. With 'flask', the application
+# sends the file itself (supporting Range requests). With 'x-accel-redirect'
+# (NGinx) or 'x-sendfile' (Apache, Lighttpd), only a header is sent and the
+# fronting web server delivers the file. For NGinx, `accel_prefix` must be
+# an internal location that maps to the `blob_prefix` directory, eg.
+#
+#   location /_registry_files/ { internal; alias /path/to/prefix/.blobs/; }
+download = {
+  'mode': 'flask',
+  'accel_prefix': '/_registry_files',
+}
+
+# The maximum size of an uploaded file in bytes.
+max_upload_size = 256 * 1024 * 1024
+
+# Chunked upload sessions store the data received so far in this directory.
+# Sessions that are not updated for `upload_session_ttl` seconds are deleted.
+upload_session_prefix = os.path.join(prefix, '.uploads')
+upload_session_ttl = 24 * 60 * 60
 
 # Mongo DB connection settings.
 mongodb = {
   'host': 'localhost',
   'port': 27017,
-  'db': 'nodepy_registry',
+  'db': os.environ.get('REGISTRY_DB', 'nodepy_registry'),
   'username': None,
   'password': None
 }
 
+# Settings for the cache of resolved manifests in /api/find. At most
+# `maxsize` resolutions are kept for `ttl` seconds.
+find_cache = {
+  'maxsize': 4096,
+  'ttl': 300
+}
+
+# Cache for the syntax highlighted manifests on the package pages. At most
+# `maxsize` results are kept in memory. If `directory` is set, the results
+# are also stored on disk.
+highlight_cache = {
+  'maxsize': 1024,
+  'directory': os.path.join(prefix, '.highlight-cache')
+}
+
+# The directory of the full-text search index. Its journal of changes is
+# compacted into the snapshot once it grows beyond `search_journal_max_size`
+# bytes.
+search_index_dir = os.path.join(prefix, '.search-index')
+search_journal_max_size = 4 * 1024 * 1024
+
+# The maximum number of package versions that /api/resolve includes in a
+# dependency tree before the request is rejected.
+resolve_max_packages = 500
+
+# If set, the package metadata is exported as static JSON files to this
+# directory on every change, see lib/export.py and `manage export-index`.
+export_dir = None
+
+# The maximum number of seconds a request to /api/changes waits for new
+# changes (long-polling).
+changes_poll_timeout = 30
+
+# PBKDF2 iterations for password hashes. Existing hashes are upgraded on
+# the next successful login when this is changed.
+password_iterations = 100000
+
+# Successful credential checks are cached for `ttl` seconds, so that the
+# slow password hash is not computed for every authenticated request.
+auth_cache = {
+  'maxsize': 1024,
+  'ttl': 60
+}
+
 # Email configuration.
 email = {
   'origin': 'no-reply@{}'.format(server_name.partition(':')[0]),
@@ -33,19 +33,37 @@ import resources from './resources'
 import utils from './utils'
 import markdown from './markdown'
 import sass from './sass'
+import assets from './assets'
+import ingest from './ingest'
 import config from "../config"
 
 app = flask.Flask('nodepy-registry', template_folder=os.path.join(__directory__, '../templates'))
 app.debug = config.debug
+app.request_class = ingest.StreamingRequest
+app.config['MAX_CONTENT_LENGTH'] = config.max_upload_size
 app.config['TEMPLATES_AUTO_RELOAD'] = True
-sass(app, force=app.debug)
+
+# Use the fingerprinted files from `manage build-assets` in production.
+# Without them, the SCSS files are compiled on request.
+assets_manifest = None if app.debug else assets.load_manifest()
+if assets_manifest is None:
+  sass(app, force=app.debug)
 
 def static(fn, dbg_force_reload=False):
+  if assets_manifest and fn in assets_manifest:
+    return utils.url_for('static', filename=assets_manifest[fn])
   result = utils.url_for('static', filename=fn)
   if app.debug and dbg_force_reload:
     result += '?v=' + str(time.time())
   return result
 
+@app.after_request
+def cache_fingerprinted_assets(response):
+  if flask.request.endpoint == 'static' and \
+      flask.request.view_args.get('filename', '').startswith('dist/'):
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+  return response
+
 # Initialize the Jinja environment globals and filters..
 app.jinja_env.globals.update({
   'VERSION': str(manifest.parse(os.path.join(__directory__, '../package.json')).version),
@@ -65,7 +83,7 @@ app.jinja_env.globals.update({
 })
 
 app.jinja_env.filters.update({
-  'markdown': lambda x: markupsafe.Markup(markdown().convert(x)),
+  'markdown': lambda x: markupsafe.Markup(markdown.create().convert(x)),
   'sizeof_fmt': utils.sizeof_fmt,
   'pygmentize': utils.pygmentize
 })
@@ -0,0 +1,102 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Builds the static assets for deployment. The SCSS files are compiled and
+every static file is copied to the `dist` directory under a name that
+contains a hash of its contents. The manifest maps the original names to
+the fingerprinted names.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sass as libsass
+
+import fs from './fs'
+
+static_dir = os.path.join(__directory__, '../static')
+scss_dir = os.path.join(static_dir, 'scss')
+css_dir = os.path.join(static_dir, 'css')
+dist_dir = os.path.join(static_dir, 'dist')
+manifest_file = os.path.join(dist_dir, 'manifest.json')
+
+
+def compile_scss():
+  """
+  Compiles all SCSS files that are not partials into the CSS directory.
+  """
+
+  for name in os.listdir(scss_dir):
+    if not name.endswith('.scss') or name.startswith('_'):
+      continue
+    css = libsass.compile(filename=os.path.join(scss_dir, name), output_style='compressed')
+    with open(os.path.join(css_dir, name[:-5] + '.css'), 'w') as fp:
+      fp.write(css)
+
+
+def fingerprint(filename, name):
+  """
+  Returns *name* with the digest of the contents of *filename* inserted
+  before the extension.
+  """
+
+  with open(filename, 'rb') as fp:
+    digest = hashlib.sha256(fp.read()).hexdigest()[:12]
+  base, ext = os.path.splitext(name)
+  return '{}.{}{}'.format(base, digest, ext)
+
+
+def build():
+  """
+  Compiles the SCSS files and copies all static files into the `dist`
+  directory with fingerprinted names. Returns the manifest.
+  """
+
+  compile_scss()
+  if os.path.isdir(dist_dir):
+    shutil.rmtree(dist_dir)
+
+  manifest = {}
+  for root, dirs, files in os.walk(static_dir):
+    dirs[:] = [d for d in dirs if os.path.join(root, d) not in (scss_dir, dist_dir)]
+    for name in files:
+      src = os.path.join(root, name)
+      rel = os.path.relpath(src, static_dir).replace(os.sep, '/')
+      dst = os.path.join(dist_dir, fingerprint(src, rel))
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+      shutil.copyfile(src, dst)
+      manifest[rel] = os.path.relpath(dst, static_dir).replace(os.sep, '/')
+
+  with fs.atomic_write(manifest_file) as fp:
+    json.dump(manifest, fp, indent=2, sort_keys=True)
+  return manifest
+
+
+def load_manifest():
+  """
+  Returns the manifest created by #build(), or None if it does not exist.
+  """
+
+  try:
+    with open(manifest_file) as fp:
+      return json.load(fp)
+  except (OSError, ValueError):
+    return None
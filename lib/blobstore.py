@@ -0,0 +1,217 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A content-addressed file store. Files are stored under the hex SHA-256
+of their contents in sharded directories, thus identical files are only
+stored once. Reference counting is done by #models.Blob.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+import config from '../config'
+import fs from './fs'
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore(object):
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def path(self, sha256):
+    return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256)
+
+  def exists(self, sha256):
+    return os.path.isfile(self.path(sha256))
+
+  def writer(self):
+    return BlobWriter(self)
+
+  def add_file(self, filename):
+    """
+    Copies the file *filename* into the store. Returns a tuple of the
+    SHA-256 and the size of the file.
+    """
+
+    with self.writer() as writer:
+      with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+          writer.write(chunk)
+      return writer.commit()
+
+  def digest(self, sha256):
+    """
+    Reads the stored file *sha256* and returns a tuple of its size and
+    SHA-512 hex digest.
+    """
+
+    hasher = hashlib.sha512()
+    size = 0
+    with open(self.path(sha256), 'rb') as fp:
+      for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+        hasher.update(chunk)
+        size += len(chunk)
+    return size, hasher.hexdigest()
+
+  def remove(self, sha256, is_referenced=None):
+    """
+    Removes the file *sha256* from the store. If specified, *is_referenced*
+    is called with the SHA-256 after the file was moved out of the way, eg.
+    #models.Blob.is_referenced(). If the blob was acquired again, the file
+    is restored instead. A concurrent #BlobWriter.commit() thus either
+    sees the file missing and stores its own copy, or its reference is
+    seen here.
+    """
+
+    path = self.path(sha256)
+    tombstone = '{}.{}.removed'.format(path, uuid.uuid4().hex)
+    try:
+      os.rename(path, tombstone)
+    except FileNotFoundError:
+      return
+    if is_referenced is not None and is_referenced(sha256):
+      # The contents are the same if a writer stored the file again.
+      os.replace(tombstone, path)
+    else:
+      os.remove(tombstone)
+
+  def collect_garbage(self, max_age):
+    """
+    Deletes temporary files that have not been written to for *max_age*
+    seconds, eg. left behind by a crashed process. Returns the number of
+    deleted files.
+    """
+
+    tmpdir = os.path.join(self.directory, 'tmp')
+    if not os.path.isdir(tmpdir):
+      return 0
+    count = 0
+    threshold = time.time() - max_age
+    for name in os.listdir(tmpdir):
+      path = os.path.join(tmpdir, name)
+      try:
+        if os.path.getmtime(path) < threshold:
+          os.remove(path)
+          count += 1
+      except FileNotFoundError:
+        pass
+    return count
+
+
+class BlobWriter(object):
+  """
+  Writes a new file to the #BlobStore. The data is written to a temporary
+  file in the store and only moved to its final location by #commit().
+  Unless committed, the temporary file is deleted when the writer is
+  closed. The SHA-512 of the file is computed alongside and available as
+  #sha512 after the commit.
+
+  If *path* is specified, that existing file is used instead of a new
+  temporary file. Its contents must be passed to #update() before the
+  commit. The file should be on the same filesystem as the store.
+  """
+
+  def __init__(self, store, path=None):
+    self.store = store
+    self.size = 0
+    self._sha256 = hashlib.sha256()
+    self._sha512 = hashlib.sha512()
+    if path is None:
+      tmpdir = os.path.join(store.directory, 'tmp')
+      os.makedirs(tmpdir, exist_ok=True)
+      fd, self.tmp_path = tempfile.mkstemp(dir=tmpdir)
+      self._fp = os.fdopen(fd, 'wb')
+    else:
+      self.tmp_path = path
+      self._fp = open(path, 'ab')
+    self.sha256 = None
+    self.sha512 = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def write(self, data):
+    self._fp.write(data)
+    self.update(data)
+
+  def update(self, data):
+    """
+    Updates the digests and size with *data* that is already in the file.
+    """
+
+    self._sha256.update(data)
+    self._sha512.update(data)
+    self.size += len(data)
+
+  def flush(self):
+    self._fp.flush()
+
+  def digests(self):
+    """
+    Returns a dictionary with the `sha256` and `sha512` hex digests of the
+    data written so far.
+    """
+
+    return {'sha256': self._sha256.hexdigest(), 'sha512': self._sha512.hexdigest()}
+
+  def commit(self, acquire=None):
+    """
+    Moves the written file to its content address. If the store already
+    contains the file, the temporary file is discarded. Returns a tuple of
+    the SHA-256 and the size of the file.
+
+    If specified, *acquire* is called with the SHA-256 before the store is
+    checked for the file, eg. #models.Blob.acquire(). Otherwise an existing
+    file could be removed by a concurrent release of its last reference
+    after the temporary file was discarded.
+    """
+
+    self._fp.flush()
+    os.fsync(self._fp.fileno())
+    self._fp.close()
+    sha256 = self._sha256.hexdigest()
+    if acquire is not None:
+      acquire(sha256)
+    path = self.store.path(sha256)
+    if os.path.isfile(path):
+      fs.silentremove(self.tmp_path)
+    else:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      os.replace(self.tmp_path, path)
+    self.sha256 = sha256
+    self.sha512 = self._sha512.hexdigest()
+    return self.sha256, self.size
+
+  def close(self):
+    if not self._fp.closed:
+      self._fp.close()
+    if self.sha256 is None:
+      fs.silentremove(self.tmp_path)
+
+
+store = BlobStore(config.blob_prefix)
@@ -0,0 +1,127 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import os
+import threading
+import time
+
+
+class LRUCache(object):
+  """
+  A thread-safe, size-bounded cache that evicts the least recently used
+  entries first. Entries older than *ttl* seconds are treated as missing.
+  A *ttl* of None disables expiration.
+  """
+
+  def __init__(self, maxsize, ttl=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        stamp, value = self._data[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      if self.ttl is not None and time.time() - stamp > self.ttl:
+        del self._data[key]
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = (time.time(), value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def discard(self, predicate):
+    """
+    Removes all entries for which *predicate(key)* returns True.
+    """
+
+    with self._lock:
+      for key in [k for k in self._data if predicate(k)]:
+        del self._data[key]
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def stats(self):
+    return {'size': len(self._data), 'maxsize': self.maxsize,
+            'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class StampFile(object):
+  """
+  A file whose modification time is used to signal changes from other
+  processes (eg. the `manage` command) to the application server. The
+  file is checked at most once every *interval* seconds.
+  """
+
+  def __init__(self, filename, interval=1.0):
+    self.filename = filename
+    self.interval = interval
+    self._checked = 0
+    self._mtime = self._getmtime()
+
+  def _getmtime(self):
+    try:
+      return os.path.getmtime(self.filename)
+    except OSError:
+      return None
+
+  def touch(self):
+    directory = os.path.dirname(self.filename)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    with open(self.filename, 'a'):
+      os.utime(self.filename, None)
+
+  def changed(self):
+    """
+    Returns True if the file was touched since the last call.
+    """
+
+    now = time.time()
+    if now - self._checked < self.interval:
+      return False
+    self._checked = now
+    mtime = self._getmtime()
+    if mtime != self._mtime:
+      self._mtime = mtime
+      return True
+    return False
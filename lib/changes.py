@@ -0,0 +1,94 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+The change log of the registry. Uploads, drops and ownership transfers are
+recorded with a monotonically increasing sequence number, which allows
+mirrors and caches to follow the registry with `/api/changes?since=<seq>`.
+"""
+
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+import models from './models'
+
+# Sequence numbers are allocated before the change is inserted, thus a
+# change with a lower number may become visible after one with a higher
+# number. Readers do not skip over such a gap unless it is older than this.
+GAP_TIMEOUT = timedelta(seconds=10)
+
+# Notified when a change is recorded by this process. Changes recorded by
+# other processes are found by polling.
+_condition = threading.Condition()
+POLL_INTERVAL = 1.0
+
+
+def record(type, package, version=None, filename=None, user=None):
+  """
+  Records a change of the *type* (see #models.Change) to *package*.
+  """
+
+  change = models.Change(type=type, package=str(package),
+      version=str(version) if version is not None else None,
+      filename=filename, user=user)
+  change.save()
+  with _condition:
+    _condition.notify_all()
+  return change
+
+
+def since(seq, limit):
+  """
+  Returns up to *limit* changes with a sequence number greater than *seq*,
+  in order. Stops before a recent gap in the sequence.
+  """
+
+  result = []
+  expected = seq + 1
+  now = datetime.now()
+  for change in models.Change.objects(seq__gt=seq).order_by('seq').limit(limit):
+    if change.seq != expected and now - change.created < GAP_TIMEOUT:
+      break
+    result.append(change)
+    expected = change.seq + 1
+  return result
+
+
+def wait(seq, limit, timeout):
+  """
+  Like #since(), but waits up to *timeout* seconds for new changes if
+  there are none.
+  """
+
+  deadline = time.time() + timeout
+  while True:
+    result = since(seq, limit)
+    remaining = deadline - time.time()
+    if result or remaining <= 0:
+      return result
+    with _condition:
+      _condition.wait(min(remaining, POLL_INTERVAL))
+
+
+def last_seq():
+  change = models.Change.objects().order_by('-seq').only('seq').first()
+  return change.seq if change else 0
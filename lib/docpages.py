@@ -0,0 +1,138 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+The Node.py documentation pages, rendered from the `_vendor/nodepy/docs`
+directory. Rendered pages are kept in memory and in a cache directory that
+is filled by the `manage build-docs` command.
+"""
+
+import hashlib
+import json
+import os
+
+import config from '../config'
+import fs from './fs'
+import markdown from './markdown'
+
+basedir = os.path.join(__directory__, '../_vendor/nodepy/docs')
+pages = require(os.path.join(basedir, '_pages.json'))
+cache_dir = os.path.join(config.prefix, '.docs-cache')
+
+
+def _index(pages, result):
+  for page in pages:
+    result[page['path']] = page
+    _index(page.get('subs', []), result)
+  return result
+
+# Maps the page paths to the page entries of the _pages.json file.
+pages_by_path = _index(pages, {})
+
+# Maps page paths to (mtime, html, toc) tuples.
+_rendered = {}
+
+
+def find_page(path):
+  return pages_by_path.get(path)
+
+
+def _cache_file(path):
+  return os.path.join(cache_dir, hashlib.sha1(str(path).encode('utf8')).hexdigest() + '.json')
+
+
+def _source_mtime(page):
+  return os.path.getmtime(os.path.join(basedir, page['file']))
+
+
+def _load_cached(path, mtime):
+  try:
+    with open(_cache_file(path), encoding='utf8') as fp:
+      data = json.load(fp)
+  except (OSError, ValueError):
+    return None
+  if data.get('mtime') != mtime or data.get('render_version') != markdown.RENDER_VERSION:
+    return None
+  return data['html'], data['toc']
+
+
+def render_page(path, write_cache=True):
+  """
+  Renders the page with the specified *path* and stores the result in
+  memory and, if *write_cache* is True, in the cache directory. Returns a
+  tuple of the HTML and the table of contents.
+  """
+
+  page = pages_by_path[path]
+  mtime = _source_mtime(page)
+  with open(os.path.join(basedir, page['file']), encoding='utf8') as fp:
+    html, toc = markdown.render(fp.read())
+  _rendered[path] = (mtime, html, toc)
+
+  if write_cache:
+    with fs.atomic_write(_cache_file(path)) as fp:
+      json.dump({'path': path, 'mtime': mtime, 'html': html, 'toc': toc,
+                 'render_version': markdown.RENDER_VERSION}, fp)
+  return html, toc
+
+
+def get_page(path, check_mtime=False):
+  """
+  Returns the HTML and table of contents of the page with the specified
+  *path*. The page is rendered only if it is neither in memory nor in the
+  cache directory. If *check_mtime* is True, cached pages whose source
+  file changed are rendered again.
+  """
+
+  entry = _rendered.get(path)
+  if entry and not check_mtime:
+    return entry[1:]
+  mtime = _source_mtime(pages_by_path[path])
+  if entry and entry[0] == mtime:
+    return entry[1:]
+  cached = _load_cached(path, mtime)
+  if cached:
+    _rendered[path] = (mtime,) + cached
+    return cached
+  return render_page(path)
+
+
+def load():
+  """
+  Loads all pages from the cache directory into memory.
+  """
+
+  for path in pages_by_path:
+    try:
+      mtime = _source_mtime(pages_by_path[path])
+    except OSError:
+      continue
+    cached = _load_cached(path, mtime)
+    if cached:
+      _rendered[path] = (mtime,) + cached
+
+
+def build():
+  """
+  Renders all pages into the cache directory. Returns the number of pages.
+  """
+
+  for path in pages_by_path:
+    render_page(path)
+  return len(pages_by_path)
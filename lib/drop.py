@@ -0,0 +1,87 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Deletes packages and package versions in bulk, used by `manage drop` and
+`manage mirror`.
+"""
+
+import concurrent.futures
+
+import blobstore from './blobstore'
+import changes from './changes'
+import export from './export'
+import findcache from './findcache'
+import models from './models'
+import search from './search'
+import suggest from './suggest'
+
+
+def remove_blob(sha256):
+  # Uploads may acquire the blob again until its file is removed.
+  blobstore.store.remove(sha256, models.Blob.is_referenced)
+
+
+def remove_blobs(digests, jobs=8):
+  with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+    list(pool.map(remove_blob, digests))
+
+
+def drop_versions(entries, keep_files=False, jobs=8):
+  """
+  Deletes package versions in bulk. *entries* is a list of tuples of a
+  #models.Package, the list of its #models.PackageVersion#s to delete and
+  whether the package itself is deleted. Unless *keep_files* is True, the
+  blobs that are no longer referenced are removed with *jobs* threads.
+  Returns the number of removed files.
+  """
+
+  versions = [v for pkg, pkg_versions, drop_package in entries for v in pkg_versions]
+  dropped = [pkg for pkg, pkg_versions, drop_package in entries if drop_package]
+
+  # The versions can not be deleted while they are referenced as the
+  # latest version of a package.
+  models.Package.objects(id__in=[x[0].id for x in entries]).update(unset__latest=True)
+  models.PackageVersion.objects(id__in=[x.id for x in versions]).delete()
+  if dropped:
+    models.Package.objects(id__in=[x.id for x in dropped]).delete()
+    models.PackageSummary.objects(name__in=[x.name for x in dropped]).delete()
+  findcache.notify()
+
+  for pkg, pkg_versions, drop_package in entries:
+    if drop_package:
+      search.remove_package(pkg.name)
+      export.remove_package(pkg.name)
+      changes.record('drop', pkg.name)
+      continue
+    for pkgv in pkg_versions:
+      changes.record('drop-version', pkg.name, pkgv.version)
+    pkg.reset_latest()
+    pkg.update_summary()
+    search.update_package(pkg)
+    export.update_package(pkg)
+  if dropped:
+    suggest.notify()
+
+  if keep_files:
+    return 0
+  freed = models.Blob.release_many(f.sha256 for v in versions for f in v.files)
+  remove_blobs(freed, jobs)
+  return len(freed)
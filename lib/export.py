@@ -0,0 +1,183 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Exports the package metadata as static JSON files that can be served by a
+plain web server from `config.export_dir`:
+
+* `packages/<name>.json` contains all versions of a package with their
+  manifests and files,
+* `index.json` maps every package name to its latest version.
+
+Files are replaced atomically, readers never see partially written files.
+The export is updated incrementally on uploads and by `manage drop`, and
+rebuilt entirely with `manage export-index`.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+
+import config from '../config'
+import models from './models'
+import fs from './fs'
+
+
+def package_file(name, directory=None):
+  directory = directory or config.export_dir
+  return os.path.join(directory, 'packages', name + '.json')
+
+
+def write_json(filename, data):
+  """
+  Atomically replaces *filename* with the JSON-encoded *data*.
+  """
+
+  # The file is served by the web server.
+  with fs.atomic_write(filename, chmod=0o644) as fp:
+    json.dump(data, fp, separators=(',', ':'), sort_keys=True)
+
+
+def version_json(package, pkgversion):
+  try:
+    manifest = json.loads(pkgversion.manifest) if pkgversion.manifest else None
+  except ValueError:
+    manifest = None
+  files = []
+  for entry in pkgversion.files:
+    data = entry.to_json()
+    data['url'] = '/api/download/{}/{}/{}'.format(package.name, pkgversion.version, entry.name)
+    files.append(data)
+  return {'manifest': manifest, 'dist': {'files': files},
+          'created': pkgversion.created.isoformat()}
+
+
+def package_json(package):
+  versions = models.PackageVersion.objects(package=package) \
+      .order_by(*models.PackageVersion.VERSION_ORDER) \
+      .exclude(*models.PackageVersion.README_FIELDS)
+  return {
+    'name': package.name,
+    'owner': package.owner.name if package.owner else None,
+    'latest': package.latest.version if package.latest else None,
+    'versions': {v.version: version_json(package, v) for v in versions}
+  }
+
+
+@contextlib.contextmanager
+def index_lock(directory):
+  """
+  Locks the index in *directory* against concurrent updates by other
+  threads and processes.
+  """
+
+  os.makedirs(directory, exist_ok=True)
+  fd = os.open(os.path.join(directory, '.index.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    yield
+  finally:
+    os.close(fd)
+
+
+def _write_index(directory):
+  summaries = models.PackageSummary.objects().order_by('name') \
+      .scalar('name', 'latest_version')
+  write_json(os.path.join(directory, 'index.json'),
+             {'packages': {name: latest for name, latest in summaries}})
+
+
+def write_index(directory=None):
+  """
+  Writes the index of all packages from the database.
+  """
+
+  directory = directory or config.export_dir
+  with index_lock(directory):
+    _write_index(directory)
+
+
+def update_index(name, latest):
+  """
+  Sets the *latest* version of package *name* in the index, or removes
+  the package if *latest* is None. Only if the index does not exist yet,
+  it is written from the database.
+  """
+
+  directory = config.export_dir
+  filename = os.path.join(directory, 'index.json')
+  with index_lock(directory):
+    try:
+      with open(filename, encoding='utf8') as fp:
+        index = json.load(fp)
+    except (OSError, ValueError):
+      _write_index(directory)
+      return
+    if latest is None:
+      index['packages'].pop(name, None)
+    else:
+      index['packages'][name] = latest
+    write_json(filename, index)
+
+
+def update_package(package):
+  """
+  Rewrites the export of the #models.Package *package* and the index. Does
+  nothing if `config.export_dir` is not set.
+  """
+
+  if not config.export_dir:
+    return
+  write_json(package_file(package.name), package_json(package))
+  update_index(package.name, package.latest.version if package.latest else None)
+
+
+def remove_package(name):
+  if not config.export_dir:
+    return
+  fs.silentremove(package_file(name))
+  update_index(name, None)
+
+
+def export(directory):
+  """
+  Exports all packages to *directory* and removes the files of packages
+  that no longer exist. Returns the number of exported packages.
+  """
+
+  names = set()
+  for package in models.Package.objects():
+    write_json(package_file(package.name, directory), package_json(package))
+    names.add(package.name)
+
+  packages_dir = os.path.join(directory, 'packages')
+  for root, dirs, files in os.walk(packages_dir):
+    for filename in files:
+      path = os.path.join(root, filename)
+      name = os.path.relpath(path, packages_dir).replace(os.sep, '/')
+      # Temporary files may belong to a concurrent update.
+      if filename.startswith('.tmp-'):
+        continue
+      if not name.endswith('.json') or name[:-len('.json')] not in names:
+        fs.silentremove(path)
+
+  write_index(directory)
+  return len(names)
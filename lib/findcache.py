@@ -0,0 +1,65 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Caches the manifests resolved by the `/api/find` endpoint, keyed by the
+package name and the normalized version selector.
+"""
+
+import os
+
+import config from '../config'
+import { LRUCache, StampFile } from './cache'
+
+cache = LRUCache(config.find_cache['maxsize'], config.find_cache['ttl'])
+
+# Touched by `manage` commands that modify packages outside of the server.
+stamp = StampFile(os.path.join(config.prefix, '.find-cache-stamp'))
+
+
+def get(package, selector):
+  if stamp.changed():
+    cache.clear()
+  return cache.get((str(package), str(selector)))
+
+
+def put(package, selector, manifest):
+  cache.set((str(package), str(selector)), manifest)
+
+
+def invalidate(package):
+  """
+  Removes all cached resolutions for *package*. Use #notify() instead when
+  not running inside the application server.
+  """
+
+  package = str(package)
+  cache.discard(lambda key: key[0] == package)
+
+
+def notify():
+  """
+  Signals the application server to drop its cache.
+  """
+
+  stamp.touch()
+
+
+def stats():
+  return cache.stats()
@@ -18,8 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import contextlib
 import errno
 import os
+import tempfile
 
 
 def silentremove(path):
@@ -28,3 +30,29 @@ def silentremove(path):
   except OSError as exc:
     if exc.errno != errno.ENOENT:
       raise
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='w', chmod=None):
+  """
+  Opens a temporary file in the directory of *filename* for writing and
+  yields the file object. When the block exits normally, the temporary
+  file replaces *filename*, otherwise it is deleted. The directory is
+  created if it does not exist. Text is written as UTF-8. As the file is
+  created readable only by the current user, *chmod* can specify other
+  permissions.
+  """
+
+  dirname = os.path.dirname(filename) or '.'
+  os.makedirs(dirname, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+  try:
+    encoding = None if 'b' in mode else 'utf8'
+    with os.fdopen(fd, mode, encoding=encoding) as fp:
+      yield fp
+    if chmod is not None:
+      os.chmod(tmp, chmod)
+    os.replace(tmp, filename)
+  except BaseException:
+    silentremove(tmp)
+    raise
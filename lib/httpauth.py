@@ -18,23 +18,90 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from flask_httpauth import HTTPBasicAuth
+import flask
+import hashlib
+import hmac
+import os
+
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+
+import config from '../config'
 import models from './models'
+import { LRUCache } from './cache'
+
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth('Bearer')
+multi_auth = MultiAuth(basic_auth, token_auth)
+
+# Maps keyed digests of verified credentials to user names. The key is
+# random per process, so the cache does not contain password hashes that
+# could be attacked offline.
+_cache = LRUCache(config.auth_cache['maxsize'], config.auth_cache['ttl'])
+_cache_key = os.urandom(32)
+
+
+def _digest(*parts):
+  return hmac.new(_cache_key, '\0'.join(parts).encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def _verify_token(token):
+  digest = _digest('token', token)
+  username = _cache.get(digest)
+  if username is None:
+    obj = models.ApiToken.verify(token)
+    if not obj:
+      return False
+    username = obj.user.name
+    _cache.set(digest, username)
+  flask.g.auth_username = username
+  return True
 
-auth = HTTPBasicAuth()
 
+@basic_auth.verify_password
+def verify_password(username, password):
+  if not username or not password:
+    return False
 
-@auth.hash_password
-def hash_pw(username, password):
-  return models.hash_password(password)
+  # API tokens can also be passed as the password.
+  if password.startswith(models.ApiToken.PREFIX):
+    return _verify_token(password) and flask.g.auth_username == username
 
+  digest = _digest('password', username, password)
+  if _cache.get(digest) == username:
+    flask.g.auth_username = username
+    return True
 
-@auth.get_password
-def get_pw(username):
   user = models.User.objects(name=username).first()
-  if user:
-    return user.passhash
-  return None
+  if not user or not models.check_password(password, user.passhash):
+    return False
+  if models.needs_rehash(user.passhash):
+    user.passhash = models.hash_password(password)
+    user.save()
+  _cache.set(digest, username)
+  flask.g.auth_username = username
+  return True
+
+
+@token_auth.verify_token
+def verify_token(token):
+  return bool(token) and _verify_token(token)
+
+
+def invalidate():
+  """
+  Clears the cache of verified credentials, eg. after a token was revoked.
+  Other processes pick up the change after `auth_cache.ttl` seconds.
+  """
+
+  _cache.clear()
+
+
+def username():
+  """
+  Returns the name of the authenticated user.
+  """
+
+  return flask.g.get('auth_username')
 
 
-exports = auth
+login_required = multi_auth.login_required
@@ -0,0 +1,300 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Single-pass ingestion of uploaded files. The #StreamingRequest writes file
+uploads directly into the #blobstore while they are received, computing
+the digests and extracting the interesting members of package archives
+on the fly.
+"""
+
+import flask
+import zlib
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import config from '../config'
+import blobstore from './blobstore'
+
+BLOCK_SIZE = 512
+
+# The archive members that are extracted by the #TarSniffer.
+ARCHIVE_MEMBERS = ('package.json', 'README.md')
+
+
+class TarSniffer(object):
+  """
+  A push-based parser for (gzipped) tar archives that extracts the members
+  listed in *names* from the data passed to #feed(). Members larger than
+  *max_member_size* are ignored. If the data is not a valid tar archive,
+  #error is set and all further data is ignored. Parsing stops once all
+  members were found or the end of the archive is reached.
+  """
+
+  def __init__(self, names=ARCHIVE_MEMBERS, max_member_size=16 * 1024 * 1024):
+    self.names = set(names)
+    self.max_member_size = max_member_size
+    self.files = {}
+    self.error = None
+    self.done = False
+    self._decompressor = None
+    self._started = False
+    self._head = b''
+    self._buffer = bytearray()
+    self._member = None      # (name, size, keep) of the current member
+    self._remaining = 0      # bytes of the current member incl. padding
+    self._data = None
+    self._next_name = None   # from a GNU long name or pax header
+    self._special = None     # type of the current special member
+
+  def feed(self, data):
+    if self.done or self.error:
+      return
+    if not self._started:
+      # The gzip magic number may be split across the first chunks.
+      self._head += data
+      if len(self._head) < 2:
+        return
+      data, self._head = self._head, b''
+      self._started = True
+      if data[:2] == b'\x1f\x8b':
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if self._decompressor is None:
+      self._process(data)
+      return
+    try:
+      while data and not (self.done or self.error):
+        chunk = self._decompressor.decompress(data, 64 * 1024)
+        data = self._decompressor.unconsumed_tail
+        self._process(chunk)
+    except zlib.error as exc:
+      self.error = 'invalid gzip data: {}'.format(exc)
+
+  def close(self):
+    if not self.done and not self.error:
+      self.error = 'unexpected end of archive'
+
+  def _process(self, data):
+    self._buffer += data
+    while not (self.done or self.error):
+      if self._member is None:
+        if len(self._buffer) < BLOCK_SIZE:
+          break
+        header = bytes(self._buffer[:BLOCK_SIZE])
+        del self._buffer[:BLOCK_SIZE]
+        self._read_header(header)
+      else:
+        if not self._buffer:
+          break
+        chunk = self._buffer[:self._remaining]
+        del self._buffer[:len(chunk)]
+        self._remaining -= len(chunk)
+        if self._data is not None:
+          self._data += chunk
+        if self._remaining == 0:
+          self._end_member()
+
+  def _read_header(self, header):
+    if header == b'\0' * BLOCK_SIZE:
+      self.done = True
+      return
+
+    checksum = sum(header[:148]) + sum(header[156:]) + 8 * 0x20
+    try:
+      if checksum != _parse_number(header[148:156]):
+        self.error = 'invalid tar header checksum'
+        return
+      size = _parse_number(header[124:136])
+    except ValueError:
+      self.error = 'invalid tar header'
+      return
+
+    name = header[0:100].split(b'\0', 1)[0]
+    if header[257:262] == b'ustar':
+      prefix = header[345:500].split(b'\0', 1)[0]
+      if prefix:
+        name = prefix + b'/' + name
+    name = name.decode('utf8', 'replace')
+    if self._next_name is not None:
+      name, self._next_name = self._next_name, None
+
+    typeflag = header[156:157]
+    if typeflag in (b'L', b'x'):
+      self._special = typeflag
+      keep = size <= self.max_member_size
+    else:
+      self._special = None
+      keep = typeflag in (b'0', b'\0') and name in self.names and \
+          size <= self.max_member_size
+
+    self._member = (name, size)
+    self._data = bytearray() if keep else None
+    self._remaining = size + (-size % BLOCK_SIZE)
+    if self._remaining == 0:
+      self._end_member()
+
+  def _end_member(self):
+    name, size = self._member
+    data = bytes(self._data[:size]) if self._data is not None else None
+    self._member = None
+    self._data = None
+    if data is None:
+      return
+    if self._special == b'L':
+      self._next_name = data.split(b'\0', 1)[0].decode('utf8', 'replace')
+    elif self._special == b'x':
+      self._next_name = _parse_pax_path(data)
+    else:
+      self.files[name] = data
+      if self.names.issubset(self.files):
+        self.done = True
+
+
+def _parse_number(field):
+  if field[0] & 0x80:
+    # GNU base-256 encoding.
+    return int.from_bytes(field[1:], 'big')
+  field = field.split(b'\0', 1)[0].strip()
+  return int(field or b'0', 8)
+
+
+def _parse_pax_path(data):
+  # Records are formatted as "<length> <key>=<value>\n".
+  while data:
+    length = data.split(b' ', 1)[0]
+    try:
+      size = int(length)
+    except ValueError:
+      return None
+    if size <= len(length):
+      return None
+    key, _, value = data[len(length) + 1:size].rstrip(b'\n').partition(b'=')
+    if key == b'path':
+      return value.decode('utf8', 'replace')
+    data = data[size:]
+  return None
+
+
+class UploadSink(object):
+  """
+  A file-like object that receives an uploaded file, passing the data to
+  a #blobstore.BlobWriter and a #TarSniffer. Raises #RequestEntityTooLarge
+  when more than `config.max_upload_size` bytes are written.
+  """
+
+  def __init__(self, path=None):
+    self.writer = blobstore.BlobWriter(blobstore.store, path)
+    self.sniffer = TarSniffer()
+
+  @classmethod
+  def from_file(cls, path):
+    """
+    Creates a sink for the complete file at *path*, which is read once to
+    compute the digests and extract the archive members. The file is moved
+    into the blob store when the writer is committed and deleted if not.
+    """
+
+    sink = cls(path)
+    try:
+      with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(blobstore.CHUNK_SIZE), b''):
+          sink.writer.update(chunk)
+          sink.sniffer.feed(chunk)
+    except BaseException:
+      sink.close()
+      raise
+    sink.sniffer.close()
+    return sink
+
+  def write(self, data):
+    if self.writer.size + len(data) > config.max_upload_size:
+      self.close()
+      raise RequestEntityTooLarge()
+    self.writer.write(data)
+    self.sniffer.feed(data)
+
+  def seek(self, offset, whence=0):
+    # Werkzeug rewinds the stream after the upload was received.
+    self.writer.flush()
+    self.sniffer.close()
+
+  def read(self, *args):
+    raise IOError('UploadSink is not readable')
+
+  def close(self):
+    self.writer.close()
+
+
+class StreamingRequest(flask.Request):
+  """
+  Flask request class that streams files uploaded to the `upload` endpoint
+  into an #UploadSink. All sinks are kept in #upload_sinks, also when
+  parsing the request fails, and are closed by #close_sinks().
+  """
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.upload_sinks = []
+
+  def _get_file_stream(self, total_content_length, content_type,
+                       filename=None, content_length=None):
+    if self.endpoint == 'upload':
+      sink = UploadSink()
+      self.upload_sinks.append(sink)
+      return sink
+    return super()._get_file_stream(total_content_length, content_type,
+        filename, content_length)
+
+  def close_sinks(self):
+    """
+    Closes all sinks of the request, deleting the files that have not been
+    committed to the blob store.
+    """
+
+    for sink in self.upload_sinks:
+      sink.close()
+
+  def close(self):
+    try:
+      super().close()
+    finally:
+      self.close_sinks()
+
+
+def sink_for(storage):
+  """
+  Returns the #UploadSink that received the file of the werkzeug
+  `FileStorage` *storage*. If the file was not received through a
+  #StreamingRequest, it is copied into a new sink.
+  """
+
+  if isinstance(storage.stream, UploadSink):
+    return storage.stream
+  sink = UploadSink()
+  try:
+    while True:
+      chunk = storage.stream.read(blobstore.CHUNK_SIZE)
+      if not chunk:
+        break
+      sink.write(chunk)
+  except BaseException:
+    sink.close()
+    raise
+  sink.seek(0)
+  return sink
@@ -18,10 +18,26 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import hashlib
 import markdown
 
+EXTENSIONS = ['admonition', 'codehilite', 'extra', 'headerid', 'meta',
+              'sane_lists', 'smarty', 'toc']
 
-def exports():
-  return markdown.Markdown(extensions=[
-        'admonition', 'codehilite', 'extra', 'headerid', 'meta',
-        'sane_lists', 'smarty', 'toc'])
+# Identifies the output of #render(). Stored HTML that was rendered with
+# a different version must be rendered again.
+RENDER_VERSION = hashlib.sha1(' '.join(EXTENSIONS).encode('utf8')).hexdigest()[:12]
+
+
+def create():
+  return markdown.Markdown(extensions=EXTENSIONS)
+
+
+def render(text):
+  """
+  Converts the Markdown *text* to HTML. Returns a tuple of the HTML and
+  the HTML of the table of contents.
+  """
+
+  md = create()
+  return md.convert(text), md.toc
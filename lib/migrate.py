@@ -18,41 +18,121 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import multiprocessing
 import os
+import threading
+import time
+
+from pymongo import ReplaceOne, UpdateOne
+
+import parallel from './parallel'
 
 
 class MigrationError(Exception):
   pass
 
 
+class Progress(object):
+  """
+  Counts the processed documents of a migration step, possibly from
+  multiple processes, and periodically prints the throughput and the
+  estimated time remaining. *done* is the number of documents that were
+  processed before, eg. when resuming from a checkpoint.
+  """
+
+  def __init__(self, total, done=0, interval=5.0):
+    self.total = total
+    self.done = done
+    self.interval = interval
+    self.start = time.time()
+    self._count = multiprocessing.get_context('fork').Value('q', done)
+    self._stop = threading.Event()
+    self._thread = None
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self._stop.set()
+    self._thread.join()
+    self.report()
+
+  def add(self, n):
+    with self._count.get_lock():
+      self._count.value += n
+
+  def report(self):
+    count = self._count.value
+    elapsed = max(time.time() - self.start, 1e-6)
+    rate = (count - self.done) / elapsed
+    line = '    {}/{} documents, {:.0f}/s'.format(count, self.total, rate)
+    if rate > 0 and count < self.total:
+      line += ', ETA {}'.format(format_duration((self.total - count) / rate))
+    elif count >= self.total:
+      line += ', took {}'.format(format_duration(elapsed))
+    print(line, flush=True)
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      self.report()
+
+
 class Migration(object):
+  """
+  Runs the migration scripts between *current_revision* and
+  *target_revision*. The revision is stored with *revisions* (usually
+  #models.MigrationRevision) after each script, and #update_collection()
+  checkpoints its progress, so an interrupted migration resumes where it
+  stopped.
 
-  def __init__(self, db, current_revision, target_revision, migrations_dir, dry=False):
+  Documents are written in batches of *batch_size*. With *jobs* > 1, the
+  documents of #update_collection() are partitioned by `_id` and processed
+  in that many forked processes, each using its own database connection
+  created with *connect*.
+  """
+
+  def __init__(self, db, current_revision, target_revision, migrations_dir,
+               dry=False, revisions=None, batch_size=1000, jobs=1, connect=None):
     if target_revision < current_revision:
       raise ValueError('target_revision must be >= current_revision')
+    if jobs > 1 and connect is None:
+      raise ValueError('connect is required with jobs > 1')
     self.db = db
     self.current_revision = current_revision
     self.target_revision = target_revision
     self.migrations_dir = migrations_dir
     self.dry = dry
+    self.revisions = revisions
+    self.batch_size = batch_size
+    self.jobs = jobs
+    self.connect = connect
+    self.revision = None
+    self._tasks = 0
 
   def execute(self):
     if self.current_revision == self.target_revision:
       print('Nothing to be migrated.')
       return
     for i in range(self.current_revision, self.target_revision):
+      self.revision = i + 1
+      self._tasks = 0
       filename = os.path.join(self.migrations_dir, '{:0>4}.py'.format(i+1))
       print('Running migration "{}" ...'.format(filename))
       self.execute_migration(filename)
+      if not self.dry and self.revisions is not None:
+        self.revisions.set(i + 1)
+        self.revisions.clear_checkpoint()
 
   def execute_migration(self, filename):
     with open(filename, 'r') as fp:
       code = compile(fp.read(), filename, 'exec')
-    scope = {'__file__': filename, 'migrate': self}
+    scope = {'__file__': filename, 'migrate': self, 'require': require}
     exec(code, scope)
 
   def _check_collection(self, collection):
-    if collection not in self.db.collection_names():
+    if collection not in self.db.list_collection_names():
       print('    warning: Database has no collection "{}"'.format(collection))
 
   def add_field(self, collection, field, value):
@@ -66,8 +146,9 @@ class Migration(object):
     if self.dry:
       print('    Skipped (dry run)')
     else:
-      result = self.db[collection].update({}, {'$set': {field: value}})
-      print('    {}'.format(result))
+      result = self.db[collection].update_many(
+          {field: {'$exists': False}}, {'$set': {field: value}})
+      print('    {} document(s) updated'.format(result.modified_count))
 
   def delete_field(self, collection, field):
     """
@@ -79,22 +160,162 @@ class Migration(object):
     if self.dry:
       print('    Skipped (dry run)')
     else:
-      result = self.db[collection].update({}, {'$unset': {field: 1}})
-      print('    {}'.format(result))
+      result = self.db[collection].update_many(
+          {field: {'$exists': True}}, {'$unset': {field: 1}})
+      print('    {} document(s) updated'.format(result.modified_count))
 
-  def update_collection(self, collection):
+  def update_collection(self, collection, query=None, projection=None,
+                        after_flush=None):
     """
     Decorator for a function that will be for all documents in the
-    specified *collection*.
+    specified *collection* matching *query*. The function either modifies
+    the document in place, in which case the whole document is replaced,
+    or returns an update document like `{'$set': {...}}`. If *projection*
+    is specified, the function must return an update document.
+
+    The documents are written in batches. Side effects that must not
+    happen before a document is written, eg. deleting files, belong in
+    *after_flush*, which is called with the list of documents of every
+    batch after it was written and checkpointed.
     """
 
     def decorator(func):
       print('  Updating collection "{}" with {}()'.format(collection, func.__name__))
       self._check_collection(collection)
-      for obj in self.db[collection].find({}):
-        func(obj)
-        if not self.dry:
-          self.db[collection].save(obj)
+      # A migration may update the same collection multiple times, the
+      # tasks are told apart by their order.
+      self._tasks += 1
+      task = '{}:{}:{}'.format(self._tasks, collection, func.__name__)
+      checkpoint = self._load_checkpoint()
+      if task in checkpoint['done']:
+        print('    Already done (checkpoint)')
+        return
+      if checkpoint.get('task') == task:
+        print('    Resuming from checkpoint')
+      else:
+        checkpoint.update({'task': task, 'bounds': self._partition(collection, query),
+                           'positions': {}, 'processed': 0,
+                           'total': self.db[collection].count_documents(query or {})})
+        self._save_checkpoint(checkpoint)
+
+      bounds = checkpoint['bounds']
+      parts = [(i, bounds[i], bounds[i+1], checkpoint['positions'].get(str(i)))
+               for i in range(len(bounds) - 1)]
+
+      def run(part):
+        return self._update_partition(collection, query, projection, func,
+            after_flush, progress, *part)
+
+      with Progress(checkpoint['total'], checkpoint['processed']) as progress:
+        if self.jobs > 1 and len(parts) > 1:
+          list(parallel.fork_map(run, parts, processes=self.jobs, chunksize=1))
+        else:
+          for part in parts:
+            run(part)
       if self.dry:
         print('    Objects not saved (dry run)')
+      else:
+        checkpoint = {'revision': self.revision, 'done': checkpoint['done'] + [task]}
+        self._save_checkpoint(checkpoint)
     return decorator
+
+  def _partition(self, collection, query):
+    """
+    Splits the documents of *collection* matching *query* into #jobs
+    ranges of `_id` of about the same size. Returns the list of range
+    boundaries, the first and last being None.
+    """
+
+    bounds = [None]
+    count = self.db[collection].count_documents(query or {})
+    if self.jobs > 1 and count > self.batch_size:
+      for i in range(1, self.jobs):
+        cursor = self.db[collection].find(query or {}, {'_id': 1}) \
+            .sort('_id', 1).skip(i * count // self.jobs).limit(1)
+        for obj in cursor:
+          if obj['_id'] != bounds[-1]:
+            bounds.append(obj['_id'])
+    bounds.append(None)
+    return bounds
+
+  def _update_partition(self, collection, query, projection, func, after_flush,
+                        progress, index, lower, upper, position):
+    if self.jobs > 1:
+      # Running in a forked process, the connection of the parent must not
+      # be used.
+      self.db = self.connect()
+    id_range = {}
+    if position is not None:
+      id_range['$gt'] = position
+    elif lower is not None:
+      id_range['$gte'] = lower
+    if upper is not None:
+      id_range['$lt'] = upper
+    filter = dict(query or {})
+    if id_range:
+      filter['_id'] = id_range
+
+    requests = []
+    processed = []
+    last_id = None
+    cursor = self.db[collection].find(filter, projection).sort('_id', 1) \
+        .batch_size(self.batch_size)
+    for obj in cursor:
+      update = func(obj)
+      if update is None:
+        if projection is not None:
+          raise MigrationError('{}() must return an update document when a '
+              'projection is used'.format(func.__name__))
+        requests.append(ReplaceOne({'_id': obj['_id']}, obj))
+      elif update:
+        requests.append(UpdateOne({'_id': obj['_id']}, update))
+      last_id = obj['_id']
+      processed.append(obj)
+      if len(processed) >= self.batch_size:
+        self._flush(collection, requests, processed, index, last_id, after_flush)
+        progress.add(len(processed))
+        requests = []
+        processed = []
+    if processed:
+      self._flush(collection, requests, processed, index, last_id, after_flush)
+      progress.add(len(processed))
+
+  def _flush(self, collection, requests, documents, index, last_id, after_flush):
+    if self.dry:
+      return
+    if requests:
+      self.db[collection].bulk_write(requests, ordered=False)
+    if self.revisions is not None:
+      self.revisions.set_checkpoint_position(self.db, index, last_id, len(documents))
+    if after_flush is not None:
+      after_flush(documents)
+
+  def _load_checkpoint(self):
+    """
+    Returns the checkpoint of the current revision. It lists the `done`
+    tasks and has the `task` in progress with the `bounds` of its
+    partitions, the `positions` reached in every partition and the number
+    of documents `processed` of the `total`.
+    """
+
+    checkpoint = None
+    if not self.dry and self.revisions is not None:
+      checkpoint = self.revisions.get_checkpoint()
+    if not checkpoint or checkpoint.get('revision') != self.revision:
+      checkpoint = {'revision': self.revision, 'done': []}
+    checkpoint = dict(checkpoint)
+    checkpoint.setdefault('done', [])
+    return checkpoint
+
+  def _save_checkpoint(self, checkpoint):
+    if not self.dry and self.revisions is not None:
+      self.revisions.set_checkpoint(checkpoint)
+
+
+def format_duration(seconds):
+  seconds = int(seconds)
+  if seconds < 60:
+    return '{}s'.format(seconds)
+  if seconds < 3600:
+    return '{}m{:0>2}s'.format(seconds // 60, seconds % 60)
+  return '{}h{:0>2}m'.format(seconds // 3600, seconds % 3600 // 60)
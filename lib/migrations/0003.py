@@ -0,0 +1,11 @@
+models = require('./models')
+
+
+@migrate.update_collection('package_version')
+def add_version_key(obj):
+  """
+  Versions are now sorted and selected by the database, which requires the
+  components of the version number to be stored in separate fields.
+  """
+
+  obj.update(models.version_key(obj['version']))
@@ -0,0 +1,10 @@
+models = require('./models')
+
+
+@migrate.update_collection('package_version')
+def add_manifest_hash(obj):
+  """
+  The hash of the manifest is used as ETag for /api/find responses.
+  """
+
+  obj['manifest_hash'] = models.manifest_hash(obj.get('manifest'))
@@ -0,0 +1,76 @@
+import os
+
+from pymongo import UpdateOne
+
+config = require('../config')
+blobstore = require('./blobstore')
+
+# Maps the ID of a converted document to the directory and files that are
+# deleted once the document is written.
+converted = {}
+
+
+def remove_sources(documents):
+  for obj in documents:
+    directory, paths = converted.pop(obj['_id'], (None, []))
+    for path in paths:
+      os.remove(path)
+    if directory:
+      try:
+        os.removedirs(directory)
+      except OSError:
+        pass
+
+
+@migrate.update_collection('package_version', after_flush=remove_sources)
+def move_files_to_blobstore(obj):
+  """
+  Package files are now stored in the content-addressed blob store instead
+  of `<prefix>/<package>/<version>/<filename>`. Each file entry now is a
+  document with the `name` and `sha256` of the file.
+
+  The source files are only deleted after the documents were written,
+  thus the migration can be resumed after it was interrupted. Adding a
+  file to the blob store is idempotent.
+  """
+
+  package = migrate.db['package'].find_one({'_id': obj['package']})
+  directory = os.path.join(config.prefix, package['name'], obj['version'])
+  files = []
+  paths = []
+  for filename in obj.get('files', []):
+    if not isinstance(filename, str):
+      files.append(filename)  # Already converted.
+      continue
+    path = os.path.join(directory, filename)
+    if not os.path.isfile(path):
+      print('    warning: missing file "{}", removed from "{}@{}"'.format(
+          path, package['name'], obj['version']))
+      continue
+    if migrate.dry:
+      continue
+    sha256, size = blobstore.store.add_file(path)
+    files.append({'name': filename, 'sha256': sha256})
+    paths.append(path)
+
+  obj['files'] = files
+  converted[obj['_id']] = (directory, paths)
+
+
+# The references are counted from the converted documents instead of being
+# incremented per file, which would count files twice when the migration
+# is resumed.
+print('  Counting blob references')
+if migrate.dry:
+  print('    Skipped (dry run)')
+else:
+  counts = migrate.db['package_version'].aggregate([
+    {'$unwind': '$files'},
+    {'$match': {'files.sha256': {'$exists': True}}},
+    {'$group': {'_id': '$files.sha256', 'refs': {'$sum': 1}}}
+  ], allowDiskUse=True)
+  requests = [UpdateOne({'sha256': x['_id']}, {'$set': {'refs': x['refs']}}, upsert=True)
+              for x in counts]
+  if requests:
+    migrate.db['blob'].bulk_write(requests, ordered=False)
+  print('    {} blob(s)'.format(len(requests)))
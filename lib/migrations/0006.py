@@ -0,0 +1,8 @@
+models = require('./models')
+
+print('  Building collection "package_summary"')
+if migrate.dry:
+  print('    Skipped (dry run)')
+else:
+  for package in models.Package.objects():
+    package.update_summary()
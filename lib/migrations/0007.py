@@ -0,0 +1,8 @@
+models = require('./models')
+
+print('  Adding "created" and "version_count" to collection "package_summary"')
+if migrate.dry:
+  print('    Skipped (dry run)')
+else:
+  for package in models.Package.objects():
+    package.update_summary()
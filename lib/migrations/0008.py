@@ -0,0 +1,38 @@
+from datetime import datetime
+
+blobstore = require('./blobstore')
+models = require('./models')
+parallel = require('./parallel')
+
+
+def digest(sha256):
+  try:
+    return sha256, blobstore.store.digest(sha256)
+  except FileNotFoundError:
+    return sha256, None
+
+
+collection = migrate.db['package_version']
+query = {'files': {'$elemMatch': {'sha512': {'$exists': False}}}}
+blobs = set()
+for obj in collection.find(query, {'files.sha256': 1}):
+  blobs.update(x['sha256'] for x in obj['files'])
+
+# Hashing the files is the expensive part, it is spread over all CPUs.
+print('  Hashing {} package file(s) ...'.format(len(blobs)))
+digests = dict(parallel.fork_map(digest, sorted(blobs)))
+
+
+@migrate.update_collection('package_version', query, {'files': 1, 'created': 1})
+def add_file_details(obj):
+  for entry in obj['files']:
+    result = digests.get(entry['sha256'])
+    if result is None:
+      print('    warning: missing blob "{}" of file "{}"'.format(
+          entry['sha256'], entry['name']))
+      entry.setdefault('size', 0)
+      continue
+    entry['size'], entry['sha512'] = result
+    entry['content_type'] = models.guess_content_type(entry['name'])
+    entry.setdefault('uploaded', obj.get('created') or datetime.now())
+  return {'$set': {'files': obj['files']}}
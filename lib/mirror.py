@@ -0,0 +1,358 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Mirrors the packages of another instance of the registry through its HTTP
+API. The first run copies every package version, later runs follow the
+change log of the source (`/api/changes`) from the sequence number stored
+in the checkpoint file, thus only the delta is transferred.
+
+Files are downloaded by a bounded pool of threads, verified against the
+digests the source reports in `/api/find` and stored like regular uploads.
+Files that are already present with the same digest are skipped.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+
+from six.moves import urllib
+
+import config from '../config'
+import changes from './changes'
+import export from './export'
+import fs from './fs'
+import models from './models'
+import ingest from './ingest'
+import blobstore from './blobstore'
+import { drop_versions } from './drop'
+import { store_upload } from './views/api'
+import registry_client from '@nodepy/nppm/lib/registry'
+import refstring from '@nodepy/nppm/lib/refstring'
+import semver from '@nodepy/nppm/lib/semver'
+
+
+class MirrorError(Exception):
+  pass
+
+
+class Mirror(object):
+  """
+  Mirrors the registry at *source* into the local database. *jobs* is the
+  maximum number of concurrent downloads.
+  """
+
+  def __init__(self, source, jobs=4, state_dir=None, log=print):
+    self.source = source.rstrip('/') + '/'
+    self.jobs = jobs
+    self.state_dir = state_dir or os.path.join(config.prefix, '.mirror')
+    self.log = log
+    self.stats = {'versions': 0, 'files': 0, 'skipped': 0, 'bytes': 0, 'dropped': 0}
+    self._synced = set()
+
+  @property
+  def state_file(self):
+    key = hashlib.sha256(self.source.encode('utf8')).hexdigest()[:16]
+    return os.path.join(self.state_dir, key + '.json')
+
+  def load_state(self):
+    try:
+      with open(self.state_file) as fp:
+        return json.load(fp)
+    except FileNotFoundError:
+      return None
+
+  def save_state(self, state):
+    with fs.atomic_write(self.state_file) as fp:
+      json.dump(state, fp)
+
+  def url(self, path, **query):
+    url = urllib.parse.urljoin(self.source, path.lstrip('/'))
+    query = {k: v for k, v in query.items() if v is not None}
+    if query:
+      url += '?' + urllib.parse.urlencode(query)
+    return url
+
+  def get_json(self, path, **query):
+    """
+    Requests *path* from the source and returns the decoded JSON response,
+    or None if the source responds with 404.
+    """
+
+    try:
+      with urllib.request.urlopen(self.url(path, **query), timeout=60) as response:
+        return json.loads(response.read().decode('utf8'))
+    except urllib.error.HTTPError as exc:
+      if exc.code == 404:
+        return None
+      raise MirrorError('{} {}'.format(exc.code, exc.geturl()))
+
+  def paginate(self, path, key):
+    cursor = None
+    while True:
+      data = self.get_json(path, limit=200, cursor=cursor)
+      if data is None:
+        return
+      yield from data[key]
+      cursor = data.get('cursor')
+      if not cursor:
+        return
+
+  def run(self, full=False):
+    """
+    Mirrors the source. Performs a full sync on the first run or if *full*
+    is True, otherwise only the changes since the last run are applied.
+    """
+
+    state = None if full else self.load_state()
+    if state is None:
+      # Remember the head of the change log before copying everything, so
+      # that changes made during the copy are applied by the next run.
+      head = self.get_json('/api/changes', limit=1)
+      self.full_sync()
+      seq = head['head'] if head else None
+      self.save_state({'source': self.source, 'seq': seq})
+      return
+
+    seq = state.get('seq')
+    if seq is None:
+      self.log('Source has no change log, performing a full sync.')
+      self.full_sync()
+      return
+
+    while True:
+      data = self.get_json('/api/changes', since=seq, limit=1000)
+      if data is None:
+        raise MirrorError('source has no change log')
+      if not data['changes']:
+        break
+      for change in data['changes']:
+        self.apply_change(change)
+        seq = change['seq']
+      self.save_state({'source': self.source, 'seq': seq})
+
+  def full_sync(self):
+    """
+    Mirrors all versions of all packages of the source. If interrupted,
+    the files that were already transferred are skipped on the next run.
+    """
+
+    tasks = []
+    owners = {}
+    for summary in self.paginate('/api/packages', 'packages'):
+      owners[summary['name']] = summary['owner']
+      for version in self.paginate('/api/packages/{}/versions'.format(summary['name']), 'versions'):
+        tasks.append((summary['name'], version['version'], summary['owner']))
+    self.sync_versions(tasks)
+    for pkg in models.Package.objects(name__in=list(owners)):
+      if owners[pkg.name] and (not pkg.owner or pkg.owner.name != owners[pkg.name]):
+        self.apply_change({'type': 'transfer', 'package': pkg.name, 'user': owners[pkg.name]})
+    # Packages that do not exist at the source are not dropped, the local
+    # registry may have packages of its own.
+
+  def apply_change(self, change):
+    package = change['package']
+    if change['type'] in ('publish', 'update', 'file'):
+      self.sync_versions([(package, change['version'], change['user'])])
+    elif change['type'] == 'transfer':
+      pkg = models.Package.objects(name=package).first()
+      if pkg:
+        pkg.owner = self.get_user(change['user'])
+        pkg.save()
+        pkg.update_summary()
+        export.update_package(pkg)
+        changes.record('transfer', package, user=change['user'])
+    elif change['type'] in ('drop', 'drop-version'):
+      # A later change may publish the version again.
+      if change['type'] == 'drop':
+        self._synced = set(x for x in self._synced if x[0] != package)
+      else:
+        self._synced.discard((package, change['version']))
+      pkg = models.Package.objects(name=package).first()
+      if not pkg:
+        return
+      query = models.PackageVersion.objects(package=pkg)
+      if change['type'] == 'drop-version':
+        query = query.filter(version=change['version'])
+      versions = list(query.only('version', 'files'))
+      drop_all = change['type'] == 'drop' or \
+          len(versions) == models.PackageVersion.objects(package=pkg).count()
+      drop_versions([(pkg, versions, drop_all)])
+      self.stats['dropped'] += len(versions)
+
+  def get_user(self, name):
+    """
+    Returns the local user *name*, creating an account that can not log in
+    if it does not exist.
+    """
+
+    user = models.User.objects(name=name).first()
+    if not user:
+      user = models.User(name=name, passhash='!', email='{}@mirror.invalid'.format(name),
+          validated=False)
+      user.save()
+    return user
+
+  def sync_versions(self, tasks):
+    """
+    Mirrors the package versions in *tasks*, a list of tuples of the
+    package name, version and owner. The files of multiple versions are
+    downloaded concurrently, but stored in order.
+    """
+
+    tasks = [x for x in tasks if (x[0], x[1]) not in self._synced]
+    with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+      # Only a bounded number of versions is downloaded ahead.
+      pending = []
+      for task in tasks:
+        pending.append((task, pool.submit(self.fetch_version, *task[:2])))
+        if len(pending) >= self.jobs * 2:
+          self.store_version(*pending.pop(0))
+      while pending:
+        self.store_version(*pending.pop(0))
+
+  def fetch_version(self, package, version):
+    """
+    Fetches the metadata of a package version and downloads the files that
+    are missing locally. Returns a list of `(filename, sink)` tuples with
+    the package archive first, or None if the version does not exist.
+    """
+
+    data = self.get_json('/api/find/{}/{}'.format(package, version))
+    if data is None or 'dist' not in data:
+      return None
+
+    local = {}
+    pkg = models.Package.objects(name=package).first()
+    if pkg:
+      pkgversion = models.PackageVersion.objects(package=pkg, version=version).only('files').first()
+      if pkgversion:
+        local = {x.name: x.sha256 for x in pkgversion.files}
+
+    archive = registry_client.get_package_archive_name(
+        refstring.parse(package).package, semver.Version(version))
+    files = sorted(data['dist']['files'], key=lambda x: x['name'] != archive)
+    result = []
+    try:
+      for entry in files:
+        if local.get(entry['name']) == entry['sha256']:
+          self.stats['skipped'] += 1
+          continue
+        result.append((entry['name'], self.download(entry)))
+    except BaseException:
+      for filename, sink in result:
+        sink.close()
+      raise
+    return result
+
+  def download(self, entry):
+    """
+    Downloads a file described by an entry of the `dist.files` of a
+    `/api/find` response into an #ingest.UploadSink and verifies its
+    digests.
+    """
+
+    url = urllib.parse.urljoin(self.source, entry['url'])
+    sink = ingest.UploadSink()
+    try:
+      with urllib.request.urlopen(url, timeout=60) as response:
+        for chunk in iter(lambda: response.read(blobstore.CHUNK_SIZE), b''):
+          sink.write(chunk)
+      sink.seek(0)
+      digests = sink.writer.digests()
+      for algorithm in ('sha256', 'sha512'):
+        if entry.get(algorithm) and entry[algorithm] != digests[algorithm]:
+          raise MirrorError('{} mismatch for "{}"'.format(algorithm, url))
+    except BaseException:
+      sink.close()
+      raise
+    return sink
+
+  def verify(self):
+    """
+    Compares the files of every package version at the source, as listed
+    by its `/api/catalog.ndjson`, with the local database. Local versions
+    of these packages that the source does not have are reported as well,
+    other local packages are ignored. Returns a tuple of the number of
+    versions checked and a list of problems, which is empty if the mirror
+    is complete.
+    """
+
+    names = {x.id: x.name for x in models.Package.objects().only('name')}
+    local = {}
+    for pkgversion in models.PackageVersion.objects().only('package', 'version', 'files') \
+        .no_dereference():
+      name = names.get(pkgversion.package.id)
+      if name:
+        local[(name, pkgversion.version)] = {x.name: x.sha256 for x in pkgversion.files}
+
+    count = 0
+    problems = []
+    packages = set()
+    try:
+      with urllib.request.urlopen(self.url('/api/catalog.ndjson'), timeout=60) as response:
+        for line in response:
+          entry = json.loads(line.decode('utf8'))
+          key = (entry['package'], entry['version'])
+          ident = '{}@{}'.format(*key)
+          count += 1
+          packages.add(entry['package'])
+          files = local.pop(key, None)
+          if files is None:
+            problems.append('{}: missing'.format(ident))
+            continue
+          for file in entry['files']:
+            if file['name'] not in files:
+              problems.append('{}: file "{}" missing'.format(ident, file['name']))
+            elif files[file['name']] != file['sha256']:
+              problems.append('{}: file "{}" differs'.format(ident, file['name']))
+    except urllib.error.HTTPError as exc:
+      raise MirrorError('{} {}'.format(exc.code, exc.geturl()))
+    for name, version in sorted(local):
+      if name in packages:
+        problems.append('{}@{}: not at the source'.format(name, version))
+    return count, problems
+
+  def store_version(self, task, future):
+    package, version, owner = task
+    files = future.result()
+    self._synced.add((package, version))
+    if files is None:
+      self.log('  skipped {}@{} (not found at the source)'.format(package, version))
+      return
+    if not files:
+      return
+
+    user = self.get_user(owner)
+    try:
+      for filename, sink in files:
+        result = store_upload(user, refstring.parse(package).package,
+            semver.Version(version), filename, sink, force=True)
+        if isinstance(result, tuple):
+          raise MirrorError('{}@{}/{}: {}'.format(package, version, filename,
+              result[0]['error']['description']))
+        self.stats['files'] += 1
+        self.stats['bytes'] += sink.writer.size
+    finally:
+      for filename, sink in files:
+        sink.close()
+    self.stats['versions'] += 1
+    self.log('  mirrored {}@{} ({} file(s))'.format(package, version, len(files)))
@@ -18,17 +18,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
 import flask
+import hmac
 import json
+import mimetypes
 import os
+import re
+import secrets
 import uuid
 
-from datetime import datetime
-from hashlib import sha512
+from datetime import datetime, timedelta
+from hashlib import pbkdf2_hmac, sha256, sha512
 from mongoengine import *
 
 import config from '../config'
 import email from './email'
+import markdown from './markdown'
+import blobstore from './blobstore'
 import semver from '@nodepy/nppm/lib/semver'
 import licenses from '@nodepy/spdx-licenses'
 
@@ -37,6 +44,8 @@ import licenses from '@nodepy/spdx-licenses'
 # TODO: Find out whether there is a timeout setting for connect().
 db = connect(**config.mongodb)[config.mongodb['db']]
 
+licenses_by_id = {lic['identifier']: lic for lic in licenses}
+
 
 class User(Document):
   name = StringField(required=True, unique=True, min_length=3, max_length=64)
@@ -47,6 +56,21 @@ class User(Document):
   validated = BooleanField(default=False)
   superuser = BooleanField(default=False)
 
+  # Sort orders for #pagination.paginate().
+  ORDERS = {
+    'name': ['name'],
+    'newest': ['-created', 'name']
+  }
+
+  meta = {
+    'auto_create_index': False,
+    'indexes': [
+      ('-created', 'name'),
+      'email',
+      {'fields': ['validation_token'], 'sparse': True}
+    ]
+  }
+
   def send_validation_mail(self):
     """
     Sends an email with a email verification link. The user must be saved
@@ -81,6 +105,15 @@ class Package(Document):
   latest = ReferenceField('PackageVersion', DENY)
   created = DateTimeField(default=datetime.now)
 
+  meta = {
+    'auto_create_index': False,
+    'indexes': [
+      ('owner', 'name'),
+      # Used by the DENY rule when a #PackageVersion is deleted.
+      {'fields': ['latest'], 'sparse': True}
+    ]
+  }
+
   def update_latest(self, version, save=True):
     assert isinstance(version, PackageVersion)
     assert version.package == self
@@ -89,28 +122,185 @@ class Package(Document):
       if save:
         self.save()
 
-  def get_directory(self):
-    return os.path.join(config.prefix, self.name)
+  def reset_latest(self, save=True):
+    """
+    Sets #latest to the highest remaining version of the package, eg.
+    after versions have been deleted.
+    """
+
+    self.latest = PackageVersion.objects(package=self) \
+        .order_by(*PackageVersion.VERSION_ORDER) \
+        .exclude(*PackageVersion.README_FIELDS).first()
+    if save:
+      self.save()
 
   def get_url(self):
     return flask.url_for('package', package=self.package.name)
 
+  def update_summary(self):
+    """
+    Updates the #PackageSummary of this package from the latest version.
+    """
+
+    summary = PackageSummary.objects(name=self.name).first() or \
+        PackageSummary(name=self.name)
+    summary.owner_name = self.owner.name if self.owner else None
+    summary.created = self.created
+    summary.version_count = PackageVersion.objects(package=self).count()
+    latest = self.latest
+    if latest:
+      summary.latest_version = latest.version
+      summary.description = (latest.manifest_json or {}).get('description')
+      lic = latest.license
+      summary.license_id = lic['identifier'] if lic else None
+      summary.license_url = lic['url'] if lic else None
+      summary.license_osi = bool(lic and lic['osi_approved'])
+    summary.save()
+
+
+class PackageSummary(Document):
+  """
+  A denormalized overview of a #Package and its latest version for package
+  listings. Kept up to date by uploads and the `manage drop` command.
+  """
+
+  name = StringField(required=True, unique=True)
+  owner_name = StringField()
+  latest_version = StringField()
+  description = StringField()
+  license_id = StringField()
+  license_url = StringField()
+  license_osi = BooleanField(default=False)
+  created = DateTimeField(default=datetime.now)
+  version_count = IntField(default=0)
+
+  # Sort orders for #pagination.paginate().
+  ORDERS = {
+    'name': ['name'],
+    'newest': ['-created', 'name'],
+    'versions': ['-version_count', 'name']
+  }
+
+  meta = {
+    'auto_create_index': False,
+    'indexes': [
+      ('-created', 'name'),
+      ('-version_count', 'name'),
+      ('owner_name', 'name'),
+      ('owner_name', '-created', 'name'),
+      ('owner_name', '-version_count', 'name')
+    ]
+  }
+
+
+class PackageFile(EmbeddedDocument):
+  """
+  A file of a #PackageVersion. The contents are stored in the #blobstore
+  under the #sha256 digest. The size and digests are recorded on upload so
+  that they don't have to be computed from the file.
+  """
+
+  name = StringField(required=True)
+  sha256 = StringField(required=True)
+  sha512 = StringField()
+  size = IntField()
+  content_type = StringField()
+  uploaded = DateTimeField(default=datetime.now)
+
+  def get_path(self):
+    return blobstore.store.path(self.sha256)
+
+  def to_json(self):
+    return {'name': self.name, 'size': self.size, 'sha256': self.sha256,
+            'sha512': self.sha512, 'content_type': self.content_type}
+
 
 class PackageVersion(Document):
   package = ReferenceField('Package', CASCADE)
   version = StringField(required=True, min_length=1)
   created = DateTimeField(default=datetime.now)
-  files = ListField(StringField())
+  files = ListField(EmbeddedDocumentField(PackageFile))
   readme = StringField()
 
+  # The #readme rendered to HTML and its table of contents, rendered with
+  # #markdown.RENDER_VERSION.
+  readme_html = StringField()
+  readme_toc = StringField()
+  readme_render_version = StringField()
+
   # Actually a JSON encoded string, but MongoDB does not allow dots in
   # documents, which may very well ocurr in package manifests.
   manifest = StringField()
 
+  # SHA-256 hex digest of #manifest, used as the ETag in /api/find.
+  manifest_hash = StringField()
+
+  # The components of #version in a form that MongoDB can sort by. These
+  # are derived from #version in #clean(), see #version_key().
+  version_major = IntField()
+  version_minor = IntField()
+  version_patch = IntField()
+  version_release = BooleanField()
+  version_prerelease = StringField()
+
+  # Order of the version fields, highest version first.
+  VERSION_ORDER = ('-version_major', '-version_minor', '-version_patch',
+      '-version_release', '-version_prerelease')
+  VERSION_FIELDS = tuple(x.lstrip('-') for x in VERSION_ORDER)
+
+  # Large fields that are only needed to display a version's README.
+  README_FIELDS = ('readme', 'readme_html', 'readme_toc')
+
+  # Sort orders for #pagination.paginate() when listing the versions of
+  # a package.
+  ORDERS = {
+    'version': list(VERSION_ORDER),
+    'newest': ['-created', 'version']
+  }
+
+  meta = {
+    'auto_create_index': False,
+    'indexes': [
+      ('package', 'version'),
+      ('package',) + VERSION_ORDER,
+      ('package', '-created', 'version'),
+      ('created', '_id')
+    ]
+  }
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self._manifest_json = None
 
+  def clean(self):
+    for key, value in version_key(self.version).items():
+      setattr(self, key, value)
+    self.manifest_hash = manifest_hash(self.manifest)
+
+  @staticmethod
+  def find_best(package, selector):
+    """
+    Returns the highest #PackageVersion of *package* that matches the
+    #semver.Selector *selector*, or None. The candidates are sorted by
+    the database using the version index and only their version number is
+    loaded. The document, except for the #README_FIELDS, is fetched only
+    for the matching version.
+    """
+
+    candidates = PackageVersion.objects(package=package) \
+        .order_by(*PackageVersion.VERSION_ORDER).scalar('id', 'version')
+    for id, version in candidates:
+      if selector(semver.Version(version)):
+        return PackageVersion.objects(id=id).exclude(*PackageVersion.README_FIELDS).first()
+    return None
+
+  def render_readme(self):
+    if self.readme:
+      self.readme_html, self.readme_toc = markdown.render(self.readme)
+    else:
+      self.readme_html = self.readme_toc = None
+    self.readme_render_version = markdown.RENDER_VERSION
+
   @property
   def manifest_json(self):
     if self._manifest_json is None and self.manifest:
@@ -136,11 +326,8 @@ class PackageVersion(Document):
     if not ident:
       return None
 
-    # TODO: Hashtable..?
-    for lic in licenses:
-      if lic['identifier'] == ident:
-        break
-    else:
+    lic = licenses_by_id.get(ident)
+    if not lic:
       return {'name': ident, 'identifier': ident, 'deprecated': False,
               'osi_approved': False, 'url': None}
 
@@ -148,20 +335,51 @@ class PackageVersion(Document):
     lic['url'] = 'https://spdx.org/licenses/{}.html'.format(lic['identifier'])
     return lic
 
-  def add_file(self, filename):
-    if filename not in self.files:
-      self.files.append(filename)
+  def get_file(self, filename):
+    for entry in self.files:
+      if entry.name == filename:
+        return entry
+    return None
 
-  def get_directory(self):
-    return os.path.join(self.package.get_directory(), self.version)
+  def add_file(self, filename, sha256, sha512, size):
+    """
+    Adds the file *filename* with the contents stored in the #blobstore
+    under *sha256*, replacing the file with the same name if it exists. The
+    caller must hold a reference to the blob, see #Blob.acquire() and
+    #blobstore.BlobWriter.commit(). Returns the #PackageFile that was
+    replaced, its blob must be released with #Blob.release() once the
+    version is saved.
+    """
+
+    old = self.get_file(filename)
+    entry = PackageFile(name=filename, sha256=sha256, sha512=sha512,
+        size=size, content_type=guess_content_type(filename))
+    if old:
+      self.files[self.files.index(old)] = entry
+    else:
+      self.files.append(entry)
+    return old
 
   def get_file_path(self, filename):
-    return os.path.join(self.get_directory(), filename)
+    entry = self.get_file(filename)
+    return entry.get_path() if entry else None
+
+  def get_modified(self):
+    """
+    Returns the date of the last change to the version, which is the
+    newest of its creation and the file uploads.
+    """
+
+    return max([self.created] + [x.uploaded for x in self.files if x.uploaded])
 
   def get_file_size(self, filename):
-    path = self.get_file_path(filename)
+    entry = self.get_file(filename)
+    if not entry:
+      return 0
+    if entry.size is not None:
+      return entry.size
     try:
-      return os.path.getsize(path)
+      return os.path.getsize(entry.get_path())
     except FileNotFoundError:
       return 0
 
@@ -169,12 +387,215 @@ class PackageVersion(Document):
     return flask.url_for('package', package=self.package.name, version=self.version)
 
 
+class Blob(Document):
+  """
+  Counts the references to a file in the #blobstore. The file is deleted
+  when the last reference is released.
+  """
+
+  sha256 = StringField(required=True, unique=True)
+  refs = IntField(default=0)
+
+  meta = {
+    'auto_create_index': False
+  }
+
+  @staticmethod
+  def acquire(sha256):
+    Blob.objects(sha256=sha256).update_one(upsert=True, inc__refs=1)
+
+  @staticmethod
+  def is_referenced(sha256):
+    return Blob.objects(sha256=sha256, refs__gt=0).first() is not None
+
+  @staticmethod
+  def release(sha256):
+    blob = Blob.objects(sha256=sha256).modify(new=True, dec__refs=1)
+    if blob and blob.refs <= 0:
+      Blob.objects(sha256=sha256, refs__lte=0).delete()
+      # Someone may have acquired the blob again in the meantime, that is
+      # checked again by the store before the file is deleted.
+      if not Blob.is_referenced(sha256):
+        blobstore.store.remove(sha256, Blob.is_referenced)
+
+  @staticmethod
+  def release_many(digests, dry=False):
+    """
+    Releases one reference for every SHA-256 in *digests*, which may
+    contain the same digest multiple times. Returns the list of digests
+    that are no longer referenced, their files must be removed from the
+    #blobstore by the caller. With *dry*, nothing is changed and the
+    digests that would be unreferenced are returned.
+
+    The files must be removed with #Blob.is_referenced() passed to
+    #blobstore.BlobStore.remove(), the blobs may be acquired again before.
+    """
+
+    counts = collections.Counter(digests)
+    if dry:
+      return [x.sha256 for x in Blob.objects(sha256__in=list(counts)).only('sha256', 'refs')
+              if x.refs - counts[x.sha256] <= 0]
+
+    # One update for all blobs that lose the same number of references.
+    by_count = collections.defaultdict(list)
+    for sha256, count in counts.items():
+      by_count[count].append(sha256)
+    for count, group in by_count.items():
+      Blob.objects(sha256__in=group).update(dec__refs=count)
+
+    unreferenced = Blob.objects(sha256__in=list(counts), refs__lte=0).scalar('sha256')
+    unreferenced = list(unreferenced)
+    Blob.objects(sha256__in=unreferenced, refs__lte=0).delete()
+    # Someone may have acquired one of the blobs again in the meantime.
+    alive = set(Blob.objects(sha256__in=unreferenced).scalar('sha256'))
+    return [x for x in unreferenced if x not in alive]
+
+
+class UploadSession(Document):
+  """
+  A file upload to a package version that is transferred in chunks. The
+  data received so far is stored in the file at #get_path().
+  """
+
+  user = ReferenceField('User', CASCADE)
+  package = StringField(required=True)
+  version = StringField(required=True)
+  filename = StringField(required=True)
+  force = BooleanField(default=False)
+  created = DateTimeField(default=datetime.now)
+  updated = DateTimeField(default=datetime.now)
+
+  meta = {
+    'auto_create_index': False,
+    'indexes': ['updated', 'user']
+  }
+
+  def get_path(self):
+    return os.path.join(config.upload_session_prefix, str(self.id))
+
+  def get_offset(self):
+    try:
+      return os.path.getsize(self.get_path())
+    except FileNotFoundError:
+      return 0
+
+  def delete(self, *args, **kwargs):
+    super().delete(*args, **kwargs)
+    try:
+      os.remove(self.get_path())
+    except FileNotFoundError:
+      pass
+
+  @staticmethod
+  def collect_garbage(max_age):
+    """
+    Deletes all sessions that have not been updated for *max_age* seconds
+    and data files that belong to no session. Returns the number of
+    deleted sessions.
+    """
+
+    count = 0
+    threshold = datetime.now() - timedelta(seconds=max_age)
+    for session in UploadSession.objects(updated__lt=threshold):
+      session.delete()
+      count += 1
+    if os.path.isdir(config.upload_session_prefix):
+      ids = set(str(x) for x in UploadSession.objects().scalar('id'))
+      for name in os.listdir(config.upload_session_prefix):
+        path = os.path.join(config.upload_session_prefix, name)
+        if name not in ids and os.path.getmtime(path) < threshold.timestamp():
+          os.remove(path)
+    return count
+
+
+class ApiToken(Document):
+  """
+  A token that authenticates a user in place of the password. Only a hash
+  of the token is stored, the token is looked up by its #prefix.
+  """
+
+  user = ReferenceField('User', CASCADE)
+  name = StringField()
+  prefix = StringField(required=True, unique=True)
+  tokenhash = StringField(required=True)
+  created = DateTimeField(default=datetime.now)
+
+  meta = {
+    'auto_create_index': False,
+    'indexes': [('user', 'created')]
+  }
+
+  PREFIX = 'npr_'
+
+  @staticmethod
+  def generate(user, name=None):
+    """
+    Creates and saves a new token for *user*. Returns a tuple of the
+    #ApiToken and the token string, which can not be retrieved later.
+    """
+
+    prefix = secrets.token_hex(6)
+    token = '{}{}_{}'.format(ApiToken.PREFIX, prefix, secrets.token_urlsafe(32))
+    obj = ApiToken(user=user, name=name, prefix=prefix,
+        tokenhash=sha256(token.encode('utf8')).hexdigest())
+    obj.save()
+    return obj, token
+
+  @staticmethod
+  def verify(token):
+    """
+    Returns the #ApiToken for the *token* string, or None if it is invalid.
+    """
+
+    if not token.startswith(ApiToken.PREFIX):
+      return None
+    prefix = token[len(ApiToken.PREFIX):].partition('_')[0]
+    obj = ApiToken.objects(prefix=prefix).first()
+    if not obj:
+      return None
+    digest = sha256(token.encode('utf8')).hexdigest()
+    if not hmac.compare_digest(digest, obj.tokenhash):
+      return None
+    return obj
+
+
+class Change(Document):
+  """
+  An entry in the change log of the registry. Every change to a package
+  gets the next #seq number, see #changes.
+  """
+
+  seq = SequenceField(unique=True)
+  type = StringField(required=True, choices=('publish', 'update', 'file',
+      'drop', 'drop-version', 'transfer'))
+  package = StringField(required=True)
+  version = StringField()
+  filename = StringField()
+  user = StringField()
+  created = DateTimeField(default=datetime.now)
+
+  meta = {
+    'auto_create_index': False
+  }
+
+  def to_json(self):
+    return {'seq': self.seq, 'type': self.type, 'package': self.package,
+            'version': self.version, 'filename': self.filename,
+            'user': self.user, 'created': self.created.isoformat()}
+
+
 class MigrationRevision(Document):
   """
-  Stores a single entity, that is the revision number of the database.
+  Stores a single entity, that is the revision number of the database and
+  the progress of the migration that is currently running.
   """
 
   revision = IntField()
+  checkpoint = DictField()
+
+  meta = {
+    'auto_create_index': False
+  }
 
   @staticmethod
   def get():
@@ -193,11 +614,136 @@ class MigrationRevision(Document):
     obj.save()
     assert MigrationRevision.get() == revision
 
+  @staticmethod
+  def get_checkpoint():
+    obj = MigrationRevision.objects().first()
+    return obj.checkpoint if obj else None
+
+  @staticmethod
+  def set_checkpoint(checkpoint):
+    MigrationRevision.objects().update_one(upsert=True, set__checkpoint=checkpoint)
+
+  @staticmethod
+  def clear_checkpoint():
+    MigrationRevision.objects().update_one(unset__checkpoint=True)
 
-def hash_password(password):
-  return sha512(password.encode('utf8')).hexdigest()
+  @staticmethod
+  def set_checkpoint_position(db, index, last_id, count):
+    """
+    Records that the documents of partition *index* of the current
+    checkpoint were migrated up to *last_id*, *count* more documents than
+    before. Uses the raw database *db*, as this is called from the worker
+    processes of a migration.
+    """
+
+    db[MigrationRevision._get_collection_name()].update_one({},
+        {'$set': {'checkpoint.positions.{}'.format(index): last_id},
+         '$inc': {'checkpoint.processed': count}})
+
+
+def hash_password(password, iterations=None):
+  """
+  Hashes *password* with PBKDF2-HMAC-SHA256 and a random salt. The result
+  contains the algorithm, iteration count and salt.
+  """
+
+  iterations = iterations or config.password_iterations
+  salt = os.urandom(16).hex()
+  digest = pbkdf2_hmac('sha256', password.encode('utf8'), salt.encode('ascii'), iterations)
+  return 'pbkdf2_sha256${}${}${}'.format(iterations, salt, digest.hex())
+
+
+def check_password(password, passhash):
+  """
+  Checks *password* against a hash created with #hash_password() or the
+  unsalted SHA-512 hex digest used by earlier versions.
+  """
+
+  if passhash.startswith('pbkdf2_sha256$'):
+    try:
+      iterations, salt, expected = passhash.split('$')[1:]
+      iterations = int(iterations)
+    except ValueError:
+      return False
+    digest = pbkdf2_hmac('sha256', password.encode('utf8'), salt.encode('ascii'), iterations)
+    return hmac.compare_digest(digest.hex(), expected)
+  return hmac.compare_digest(sha512(password.encode('utf8')).hexdigest(), passhash)
+
+
+def needs_rehash(passhash):
+  return not passhash.startswith('pbkdf2_sha256${}$'.format(config.password_iterations))
+
+
+def manifest_hash(manifest):
+  if manifest is None:
+    return None
+  return sha256(manifest.encode('utf8')).hexdigest()
+
+
+def guess_content_type(filename):
+  if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+    return 'application/gzip'
+  return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def version_key(version):
+  """
+  Splits a semantic version string into a dictionary of the #PackageVersion
+  fields that are used to sort versions in the database. Numeric prerelease
+  identifiers are zero-padded and prefixed so that a plain string comparison
+  yields the semver precedence.
+  """
+
+  match = re.match(r'^(\d+)\.(\d+)\.(\d+)(?:-([^+]+))?(?:\+.*)?$', str(version))
+  if not match:
+    raise ValueError('invalid version: {!r}'.format(version))
+
+  prerelease = []
+  for ident in (match.group(4) or '').split('.'):
+    if not ident:
+      continue
+    if ident.isdigit():
+      prerelease.append('0' + ident.zfill(20))
+    else:
+      prerelease.append('1' + ident)
+
+  return {
+    'version_major': int(match.group(1)),
+    'version_minor': int(match.group(2)),
+    'version_patch': int(match.group(3)),
+    'version_release': not prerelease,
+    # \x01 sorts before any character allowed in an identifier.
+    'version_prerelease': '\x01'.join(prerelease)
+  }
+
+
+DOCUMENTS = (User, Package, PackageSummary, PackageVersion, Blob,
+             UploadSession, ApiToken, Change, MigrationRevision)
+
+
+def ensure_indexes(background=True):
+  """
+  Creates the indexes declared in the `meta` of all #DOCUMENTS that do not
+  exist yet, in the background unless *background* is False. Returns a
+  list of `(collection, index name)` tuples of the created indexes.
+
+  The documents disable `auto_create_index`, so this is the only place
+  where indexes are built. Otherwise mongoengine would build them in the
+  foreground on the first access to a collection, eg. in a request.
+  """
 
+  created = []
+  for cls in DOCUMENTS:
+    collection = cls._get_collection()
+    existing = set(collection.index_information())
+    for spec in cls._meta['index_specs']:
+      spec = dict(spec)
+      fields = spec.pop('fields')
+      name = collection.create_index(fields, background=background, **spec)
+      if name not in existing:
+        created.append((collection.name, name))
+  return created
 
 
 CURRENT_REVISION = MigrationRevision.get()
-TARGET_REVISION = 2  # Current revision number of our models.
+TARGET_REVISION = 8  # Current revision number of our models.
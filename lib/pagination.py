@@ -0,0 +1,122 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Keyset (cursor-based) pagination for MongoEngine querysets. A page is
+continued after the sort key of its last document instead of skipping a
+number of documents, thus every page costs the same index range scan.
+"""
+
+import base64
+import collections
+import flask
+
+from bson import json_util
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+Page = collections.namedtuple('Page', 'items cursor sort limit')
+
+
+class InvalidCursor(ValueError):
+  pass
+
+
+def encode_cursor(values):
+  data = json_util.dumps(values).encode('utf8')
+  return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+  try:
+    data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    values = json_util.loads(data.decode('utf8'))
+  except (ValueError, TypeError):
+    raise InvalidCursor(cursor)
+  if not isinstance(values, list):
+    raise InvalidCursor(cursor)
+  return values
+
+
+def after(order, values):
+  """
+  Builds a MongoDB query that matches the documents sorted after the
+  document with the specified sort key *values* for the *order*, which
+  is a list of field names optionally prefixed with `-` for a descending
+  sort. The last field in *order* must be unique.
+  """
+
+  if len(values) != len(order):
+    raise InvalidCursor(values)
+  clauses = []
+  for i, spec in enumerate(order):
+    field = spec.lstrip('-')
+    op = '$lt' if spec.startswith('-') else '$gt'
+    clause = {_db_field(f.lstrip('-')): v for f, v in zip(order[:i], values[:i])}
+    clause[_db_field(field)] = {op: values[i]}
+    clauses.append(clause)
+  return {'$or': clauses}
+
+
+def _db_field(name):
+  return '_id' if name == 'id' else name
+
+
+def paginate(queryset, orders, sort, cursor=None, limit=DEFAULT_LIMIT):
+  """
+  Returns a #Page of the documents in *queryset*. *orders* maps the names
+  of the available sort orders to a list of field names (see #after()).
+  *sort* selects the order, *cursor* is the cursor of the previous page
+  and *limit* the maximum number of documents on the page. The returned
+  #Page.cursor is None if there are no more documents. Raises
+  #InvalidCursor or #KeyError if *cursor* or *sort* are invalid.
+  """
+
+  order = orders[sort]
+  if cursor:
+    queryset = queryset.filter(__raw__=after(order, decode_cursor(cursor)))
+  items = list(queryset.order_by(*order).limit(limit + 1))
+  next_cursor = None
+  if len(items) > limit:
+    items = items[:limit]
+    last = items[-1]
+    next_cursor = encode_cursor([getattr(last, f.lstrip('-')) for f in order])
+  return Page(items, next_cursor, sort, limit)
+
+
+def from_request(queryset, orders, default_sort):
+  """
+  Like #paginate(), but reads the `sort`, `cursor` and `limit` from the
+  query parameters of the current request. Aborts with 400 if they are
+  invalid.
+  """
+
+  sort = flask.request.args.get('sort', default_sort)
+  if sort not in orders:
+    flask.abort(400)
+  try:
+    limit = int(flask.request.args.get('limit', DEFAULT_LIMIT))
+  except ValueError:
+    flask.abort(400)
+  limit = max(1, min(limit, MAX_LIMIT))
+  try:
+    return paginate(queryset, orders, sort, flask.request.args.get('cursor'), limit)
+  except InvalidCursor:
+    flask.abort(400)
@@ -0,0 +1,96 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+
+def fork_map(func, iterable, processes=None, chunksize=16):
+  """
+  Like #multiprocessing.Pool.imap_unordered(), but the worker processes are
+  forked and inherit *func* instead of receiving it pickled. This allows
+  *func* to be any callable, including functions of Node.py modules which
+  can not be pickled by reference. The items and results must be picklable
+  and *func* should not use the database connection of the parent.
+  """
+
+  ctx = multiprocessing.get_context('fork')
+  processes = processes or os.cpu_count() or 1
+  tasks = ctx.Queue(processes * 2)
+  results = ctx.Queue()
+
+  def worker():
+    while True:
+      chunk = tasks.get()
+      if chunk is None:
+        break
+      try:
+        results.put((True, [func(x) for x in chunk]))
+      except BaseException:
+        results.put((False, traceback.format_exc()))
+
+  state = {'sent': 0, 'done': False, 'error': None}
+
+  def feeder():
+    chunk = []
+    try:
+      for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+          tasks.put(chunk)
+          state['sent'] += 1
+          chunk = []
+      if chunk:
+        tasks.put(chunk)
+        state['sent'] += 1
+    except BaseException as exc:
+      state['error'] = exc
+    finally:
+      state['done'] = True
+      for i in range(processes):
+        tasks.put(None)
+
+  workers = [ctx.Process(target=worker, daemon=True) for i in range(processes)]
+  for proc in workers:
+    proc.start()
+  feed_thread = threading.Thread(target=feeder, daemon=True)
+  feed_thread.start()
+
+  received = 0
+  try:
+    while not (state['done'] and received == state['sent']):
+      try:
+        ok, value = results.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      received += 1
+      if not ok:
+        raise RuntimeError('fork_map() worker failed:\n' + value)
+      yield from value
+    if state['error'] is not None:
+      raise state['error']
+  finally:
+    for proc in workers:
+      proc.terminate()
+    for proc in workers:
+      proc.join()
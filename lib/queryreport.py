@@ -0,0 +1,107 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Runs `explain` on the query shapes used by the registry and reports the
+queries that are not supported by an index.
+"""
+
+from bson import ObjectId
+from datetime import datetime
+
+import models from './models'
+
+# The queries of the registry as `(description, document class, filter,
+# sort)`. The values only need to have the right type.
+SHAPES = [
+  ('user by name', models.User, {'name': ''}, None),
+  ('user by email', models.User, {'email': ''}, None),
+  ('user by validation token', models.User, {'validation_token': ''}, None),
+  ('user listing', models.User, {}, [('created', -1), ('name', 1)]),
+  ('package by name', models.Package, {'name': ''}, None),
+  ('packages by owner', models.Package, {'owner': ObjectId()}, None),
+  ('package by latest version', models.Package, {'latest': ObjectId()}, None),
+  ('package listing', models.PackageSummary, {}, [('name', 1)]),
+  ('package listing (newest)', models.PackageSummary, {}, [('created', -1), ('name', 1)]),
+  ('packages of user', models.PackageSummary, {'owner_name': ''}, [('name', 1)]),
+  ('package version', models.PackageVersion, {'package': ObjectId(), 'version': ''}, None),
+  ('best version', models.PackageVersion, {'package': ObjectId()},
+      [(x.lstrip('-'), -1 if x.startswith('-') else 1) for x in models.PackageVersion.VERSION_ORDER]),
+  ('version listing (newest)', models.PackageVersion, {'package': ObjectId()},
+      [('created', -1), ('version', 1)]),
+  ('catalog since', models.PackageVersion, {'created': {'$gte': datetime.now()}},
+      [('created', 1), ('_id', 1)]),
+  ('blob by digest', models.Blob, {'sha256': ''}, None),
+  ('expired upload sessions', models.UploadSession, {'updated': {'$lt': datetime.now()}}, None),
+  ('upload sessions of user', models.UploadSession, {'user': ObjectId()}, None),
+  ('api token by prefix', models.ApiToken, {'prefix': ''}, None),
+  ('api tokens of user', models.ApiToken, {'user': ObjectId()}, [('created', 1)]),
+]
+
+
+def iter_plan(plan, key):
+  """
+  Yields the values of *key* in all stages of an explained query plan, eg.
+  `stage` or `indexName`.
+  """
+
+  if isinstance(plan, dict):
+    if key in plan:
+      yield plan[key]
+    for value in plan.values():
+      yield from iter_plan(value, key)
+  elif isinstance(plan, list):
+    for value in plan:
+      yield from iter_plan(value, key)
+
+
+def explain(cls, filter, sort=None):
+  """
+  Explains a query and returns a dictionary with the `stages` of the
+  winning plan, the `indexes` used and the number of documents and keys
+  examined. `collscan` and `sort` are True if the collection is scanned
+  or the result is sorted in memory.
+  """
+
+  cursor = cls._get_collection().find(filter)
+  if sort:
+    cursor = cursor.sort(sort)
+  result = cursor.explain()
+  plan = result['queryPlanner']['winningPlan']
+  stages = list(iter_plan(plan, 'stage'))
+  stats = result.get('executionStats', {})
+  return {
+    'stages': stages,
+    'indexes': sorted(set(iter_plan(plan, 'indexName'))),
+    'collscan': 'COLLSCAN' in stages,
+    'sort': 'SORT' in stages,
+    'docs_examined': stats.get('totalDocsExamined'),
+    'keys_examined': stats.get('totalKeysExamined'),
+  }
+
+
+def report():
+  """
+  Explains all #SHAPES. Returns a list of `(description, collection,
+  result)` tuples, see #explain().
+  """
+
+  return [(desc, cls._get_collection_name(), explain(cls, filter, sort))
+          for desc, cls, filter, sort in SHAPES]
@@ -0,0 +1,87 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import semver from '@nodepy/nppm/lib/semver'
+
+
+class ResolveError(Exception):
+  pass
+
+
+class PackageNotFound(ResolveError):
+  pass
+
+
+class DependencyResolver(object):
+  """
+  Resolves the full dependency closure of a set of packages. *find* must
+  be a function that accepts a package name and a #semver.Selector and
+  returns the manifest of the best matching version as a dictionary, or
+  None if there is no such version.
+
+  Every resolved package version is visited only once, thus cycles in the
+  dependency graph terminate the traversal and are recorded in #cycles.
+  """
+
+  def __init__(self, find, max_packages):
+    self.find = find
+    self.max_packages = max_packages
+    self.packages = {}
+    self.cycles = []
+
+  def resolve(self, package, selector, path=()):
+    """
+    Resolves *package* matching *selector* and all of its dependencies.
+    Returns the identifier (`name@version`) of the chosen version.
+    """
+
+    manifest = self.find(package, selector)
+    if manifest is None:
+      msg = 'No package matching "{}@{}" could be found'.format(
+          package, selector or 'latest')
+      if path:
+        msg += ' (required by "{}")'.format(path[-1])
+      raise PackageNotFound(msg)
+
+    ident = '{}@{}'.format(package, manifest['version'])
+    if ident in path:
+      self.cycles.append(list(path[path.index(ident):]) + [ident])
+      return ident
+    if ident in self.packages:
+      return ident
+
+    if len(self.packages) >= self.max_packages:
+      raise ResolveError('The dependency tree exceeds the maximum of {} '
+          'packages'.format(self.max_packages))
+
+    entry = {'name': package, 'version': manifest['version'],
+             'manifest': manifest, 'dependencies': {}}
+    self.packages[ident] = entry
+
+    for dep_name, dep_selector in (manifest.get('dependencies') or {}).items():
+      try:
+        dep_selector = semver.Selector(dep_selector)
+      except ValueError:
+        # Not a registry dependency (eg. a Git URL or local path).
+        continue
+      entry['dependencies'][dep_name] = self.resolve(
+          dep_name, dep_selector, path + (ident,))
+
+    return ident
@@ -38,7 +38,7 @@ def convert(scss, css):
     try:
       os.remove(css)
     except OSError as exc:
-      if exc.errno != errno.EOENT:
+      if exc.errno != errno.ENOENT:
         raise
     raise
 
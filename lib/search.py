@@ -0,0 +1,335 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Full-text search over the name, description, keywords and README of the
+latest version of every package, ranked with BM25.
+
+The index is persisted as a snapshot plus a journal of changes that every
+process appends to. Processes replay the journal entries written by others
+before searching, thus uploads and `manage drop` become visible everywhere
+without a full rebuild.
+"""
+
+import collections
+import contextlib
+import fcntl
+import json
+import math
+import os
+import re
+import threading
+
+import config from '../config'
+import fs from './fs'
+import models from './models'
+
+# Terms in the name, description and keywords weigh more than in the README.
+FIELD_WEIGHTS = {'name': 5, 'description': 3, 'keywords': 3, 'readme': 1}
+
+STOPWORDS = frozenset('a an and are as at be by for from has in is it of on '
+                      'or that the this to was with'.split())
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+  return [t for t in re.findall(r'[a-z0-9]+', text.lower())
+          if len(t) > 1 and t not in STOPWORDS]
+
+
+def analyze(fields):
+  """
+  Converts a dictionary of *fields* (see #FIELD_WEIGHTS) to a tuple of the
+  weighted term frequencies and the document length.
+  """
+
+  terms = collections.Counter()
+  for field, text in fields.items():
+    weight = FIELD_WEIGHTS[field]
+    for token in tokenize(text or ''):
+      terms[token] += weight
+  return dict(terms), sum(terms.values())
+
+
+def package_fields(pkgversion):
+  manifest = pkgversion.manifest_json or {}
+  keywords = manifest.get('keywords') or []
+  if not isinstance(keywords, list):
+    keywords = [str(keywords)]
+  return {
+    'name': pkgversion.package.name.replace('@', ' ').replace('/', ' '),
+    'description': manifest.get('description') or '',
+    'keywords': ' '.join(map(str, keywords)),
+    'readme': pkgversion.readme or ''
+  }
+
+
+def _file_id(stat):
+  # The snapshot is replaced on every compaction.
+  return (stat.st_ino, stat.st_mtime_ns)
+
+
+class SearchIndex(object):
+  """
+  The search index in *directory*. Once the journal grows beyond
+  *max_journal_size* bytes, it is compacted by the next #add() or
+  #remove() of a process that loaded the snapshot.
+  """
+
+  def __init__(self, directory, max_journal_size=None):
+    self.snapshot_file = os.path.join(directory, 'snapshot.json')
+    self.journal_file = os.path.join(directory, 'journal.jsonl')
+    self.directory = directory
+    self.max_journal_size = max_journal_size
+    self.loaded = False
+    self._lock = threading.RLock()
+    self._reset()
+
+  def _reset(self):
+    self.docs = {}        # name -> (terms, length)
+    self.postings = {}    # term -> {name: frequency}
+    self.total_length = 0
+    self._journal_offset = 0
+    self._snapshot_id = None
+
+  def _add(self, name, terms, length):
+    self._remove(name)
+    self.docs[name] = (terms, length)
+    self.total_length += length
+    for term, freq in terms.items():
+      self.postings.setdefault(term, {})[name] = freq
+
+  def _remove(self, name):
+    doc = self.docs.pop(name, None)
+    if doc is None:
+      return
+    terms, length = doc
+    self.total_length -= length
+    for term in terms:
+      postings = self.postings[term]
+      del postings[name]
+      if not postings:
+        del self.postings[term]
+
+  def _apply(self, entry):
+    if entry['op'] == 'add':
+      self._add(entry['name'], entry['terms'], entry['length'])
+    elif entry['op'] == 'remove':
+      self._remove(entry['name'])
+
+  @contextlib.contextmanager
+  def _journal_lock(self):
+    """
+    Opens the journal for appending and locks it against other processes.
+    Yields the file descriptor.
+    """
+
+    os.makedirs(self.directory, exist_ok=True)
+    fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield fd
+    finally:
+      os.close(fd)
+
+  def _append(self, entry):
+    data = (json.dumps(entry) + '\n').encode('utf8')
+    with self._journal_lock() as fd:
+      while data:
+        data = data[os.write(fd, data):]
+
+  def load(self):
+    """
+    Loads the snapshot and replays the journal. Returns False if there is
+    no snapshot, ie. the index must be built with #rebuild(). The journal
+    alone only contains the packages that changed since the deployment.
+    """
+
+    with self._lock:
+      self._reset()
+      found = False
+      try:
+        with open(self.snapshot_file, encoding='utf8') as fp:
+          self._snapshot_id = _file_id(os.fstat(fp.fileno()))
+          data = json.load(fp)
+      except (OSError, ValueError):
+        pass
+      else:
+        found = True
+        for name, (terms, length) in data['docs'].items():
+          self._add(name, terms, length)
+      self.loaded = found
+      self.refresh()
+      return found
+
+  def refresh(self):
+    """
+    Applies the journal entries that were written since the last call.
+    Returns True if the journal exists.
+    """
+
+    with self._lock:
+      try:
+        size = os.path.getsize(self.journal_file)
+      except OSError:
+        return False
+      try:
+        snapshot_id = _file_id(os.stat(self.snapshot_file))
+      except OSError:
+        snapshot_id = None
+      if size < self._journal_offset or snapshot_id != self._snapshot_id:
+        # The journal was compacted by another process. It may have grown
+        # beyond our offset again since.
+        return self.load()
+      if size == self._journal_offset:
+        return True
+      with open(self.journal_file, 'rb') as fp:
+        fp.seek(self._journal_offset)
+        for line in fp:
+          if not line.endswith(b'\n'):
+            break  # Incomplete write, read it next time.
+          self._journal_offset += len(line)
+          try:
+            entry = json.loads(line.decode('utf8'))
+          except ValueError:
+            continue  # Skip corrupted entries instead of failing forever.
+          self._apply(entry)
+      return True
+
+  def compact(self, min_size=0):
+    """
+    Writes the current index to the snapshot and empties the journal,
+    unless the journal is smaller than *min_size* bytes (eg. because
+    another process compacted it in the meantime).
+    """
+
+    # Entries can not be appended by other processes while the journal is
+    # locked, thus none get lost when it is truncated.
+    with self._lock, self._journal_lock() as journal_fd:
+      self.refresh()
+      if self._journal_offset < min_size:
+        return
+      with fs.atomic_write(self.snapshot_file) as fp:
+        json.dump({'docs': self.docs}, fp)
+      os.truncate(journal_fd, 0)
+      self._journal_offset = 0
+      self._snapshot_id = _file_id(os.stat(self.snapshot_file))
+      self.loaded = True
+
+  def _maybe_compact(self):
+    # Without the snapshot, the index only contains the journal entries
+    # and the compacted snapshot would miss all other packages.
+    if self.loaded and self.max_journal_size is not None and \
+        self._journal_offset >= self.max_journal_size:
+      self.compact(self.max_journal_size)
+
+  def add(self, name, fields):
+    terms, length = analyze(fields)
+    entry = {'op': 'add', 'name': name, 'terms': terms, 'length': length}
+    with self._lock:
+      self.refresh()
+      self._append(entry)
+      self.refresh()
+      self._maybe_compact()
+
+  def remove(self, name):
+    with self._lock:
+      self.refresh()
+      self._append({'op': 'remove', 'name': name})
+      self.refresh()
+      self._maybe_compact()
+
+  def rebuild(self, items):
+    """
+    Replaces the index with the documents in *items*, an iterable of
+    (name, fields) tuples, and compacts it.
+    """
+
+    with self._lock:
+      self._reset()
+      for name, fields in items:
+        self._add(name, *analyze(fields))
+      self._journal_offset = os.path.getsize(self.journal_file) \
+          if os.path.exists(self.journal_file) else 0
+      self.compact()
+
+  def search(self, query):
+    """
+    Returns a list of (name, score) tuples for the documents that match
+    any term of *query*, best match first.
+    """
+
+    with self._lock:
+      self.refresh()
+      count = len(self.docs)
+      if not count:
+        return []
+      avg_length = self.total_length / count
+      scores = collections.Counter()
+      for term in set(tokenize(query)):
+        postings = self.postings.get(term)
+        if not postings:
+          continue
+        idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+        for name, freq in postings.items():
+          norm = K1 * (1 - B + B * self.docs[name][1] / avg_length)
+          scores[name] += idf * freq * (K1 + 1) / (freq + norm)
+      return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+
+index = SearchIndex(config.search_index_dir, config.search_journal_max_size)
+_loaded = False
+
+
+def get_index():
+  """
+  Returns the #SearchIndex, loading it on first use. If it was never built,
+  it is built from the database.
+  """
+
+  global _loaded
+  if not _loaded:
+    if not index.load():
+      rebuild()
+    _loaded = True
+  return index
+
+
+def rebuild():
+  versions = (p.latest for p in models.Package.objects() if p.latest)
+  index.rebuild((v.package.name, package_fields(v)) for v in versions)
+
+
+def update_package(package):
+  """
+  Updates the index entry of the #models.Package *package* from its latest
+  version.
+  """
+
+  if package.latest:
+    get_index().add(package.name, package_fields(package.latest))
+  else:
+    get_index().remove(package.name)
+
+
+def remove_package(name):
+  get_index().remove(name)
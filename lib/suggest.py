@@ -0,0 +1,115 @@
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+In-memory prefix index over the package names for autocompletion.
+"""
+
+import bisect
+import os
+import threading
+
+import config from '../config'
+import models from './models'
+import { StampFile } from './cache'
+
+
+class PrefixIndex(object):
+  """
+  Maps lowercase keys to package names. The keys are kept in a sorted list
+  so that all keys with a common prefix form a contiguous range that is
+  found with a binary search. A scoped package `@scope/name` is indexed by
+  its full name and by `name`.
+  """
+
+  def __init__(self, names=()):
+    self._entries = sorted(e for name in names for e in self._keys(name))
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _keys(name):
+    result = [(name.lower(), name)]
+    if name.startswith('@') and '/' in name:
+      result.append((name.partition('/')[2].lower(), name))
+    return result
+
+  def add(self, name):
+    with self._lock:
+      for entry in self._keys(name):
+        index = bisect.bisect_left(self._entries, entry)
+        if index == len(self._entries) or self._entries[index] != entry:
+          self._entries.insert(index, entry)
+
+  def remove(self, name):
+    with self._lock:
+      for entry in self._keys(name):
+        index = bisect.bisect_left(self._entries, entry)
+        if index < len(self._entries) and self._entries[index] == entry:
+          del self._entries[index]
+
+  def find(self, prefix, limit=10):
+    """
+    Returns up to *limit* package names that have a key starting with
+    *prefix*, ordered by key.
+    """
+
+    prefix = prefix.lower()
+    entries = self._entries
+    index = bisect.bisect_left(entries, (prefix,))
+    result = []
+    while index < len(entries) and len(result) < limit:
+      key, name = entries[index]
+      if not key.startswith(prefix):
+        break
+      if name not in result:
+        result.append(name)
+      index += 1
+    return result
+
+
+index = None
+
+# Touched when packages are created or removed, the other server processes
+# and `manage` commands then rebuild their index.
+stamp = StampFile(os.path.join(config.prefix, '.suggest-stamp'))
+
+
+def rebuild():
+  global index
+  index = PrefixIndex(models.Package.objects().scalar('name'))
+
+
+def get_index():
+  if index is None or stamp.changed():
+    rebuild()
+  return index
+
+
+def add(name):
+  if index is not None:
+    index.add(name)
+
+
+def remove(name):
+  if index is not None:
+    index.remove(name)
+
+
+def notify():
+  stamp.touch()
@@ -19,12 +19,18 @@
 # THE SOFTWARE.
 
 import flask
+import hashlib
 import jinja2
 import markupsafe
+import os
 import pygments
 import pygments.lexers
 import pygments.formatters
 
+import cache from './cache'
+import fs from './fs'
+import config from '../config'
+
 
 def sizeof_fmt(num, suffix='B'):
   # http://stackoverflow.com/a/1094933/791713
@@ -44,16 +50,41 @@ def url_for(*args, **kwargs):
   return flask.url_for(*args, **kwargs).replace('%40', '@')
 
 
+_lexers = {
+  'json': pygments.lexers.JsonLexer(),
+  'python': pygments.lexers.PythonLexer()
+}
+_formatter = pygments.formatters.HtmlFormatter(cssclass='codehilite')
+_highlight_cache = cache.LRUCache(config.highlight_cache['maxsize'])
+
+
 def pygmentize(code, language):
   """
+  Highlights *code* as HTML. The result is cached by the hash of the code
+  in memory and, if `config.highlight_cache['directory']` is set, on disk.
   """
 
-  lexers = {
-    'json': pygments.lexers.JsonLexer,
-    'python': pygments.lexers.PythonLexer
-  }
-  fmt = pygments.formatters.HtmlFormatter(cssclass='codehilite')
-  res = pygments.highlight(code, lexers[language](), fmt)
+  key = '{}-{}'.format(language, hashlib.sha256(code.encode('utf8')).hexdigest())
+  res = _highlight_cache.get(key)
+  if res is not None:
+    return markupsafe.Markup(res)
+
+  directory = config.highlight_cache['directory']
+  filename = os.path.join(directory, key + '.html') if directory else None
+  res = None
+  if filename:
+    try:
+      with open(filename, encoding='utf8') as fp:
+        res = fp.read()
+    except OSError:
+      pass
+  if res is None:
+    res = pygments.highlight(code, _lexers[language], _formatter)
+    if filename:
+      with fs.atomic_write(filename) as fp:
+        fp.write(res)
+
+  _highlight_cache.set(key, res)
   return markupsafe.Markup(res)
 
 
@@ -23,20 +23,30 @@ import functools
 import io
 import json
 import os
-import shutil
 import sys
-import tarfile
-import tempfile
+import zlib
 
+from datetime import datetime, timezone
 from flask import request
+from six.moves import urllib
+from werkzeug.http import http_date
 from flask_restful import Resource, Api
+from mongoengine import ValidationError
 
-import fs from '../fs'
+import blobstore from '../blobstore'
 import config from '../../config'
 import resources from '../resources'
 import app from '../app'
 import httpauth from '../httpauth'
+import changes from '../changes'
 import decorators from '../decorators'
+import export from '../export'
+import findcache from '../findcache'
+import ingest from '../ingest'
+import pagination from '../pagination'
+import search from '../search'
+import suggest from '../suggest'
+import { DependencyResolver, ResolveError, PackageNotFound } from '../resolve'
 import models, { User, Package, PackageVersion } from '../models'
 import manifest from '@nodepy/nppm/lib/manifest'
 import semver from '@nodepy/nppm/lib/semver'
@@ -65,6 +75,92 @@ def service_unavailable(description):
   return _error('Serice unavailable', description, 503)
 
 
+def find_version(package, selector, is_fresh=None):
+  """
+  Finds the highest version of *package* that matches the #semver.Selector
+  *selector* and returns a dictionary with its `manifest` (parsed), `dist`
+  information about its files, `etag` and `modified` date, or None if no
+  version matches. If *selector* is None,
+  the latest version is returned.
+
+  If the version is not cached and *is_fresh* returns True for its ETag
+  and modified date, eg. #not_modified(), the manifest is not parsed and
+  the dictionary only contains the `etag` and `modified` date.
+  """
+
+  entry = findcache.get(package, selector)
+  if entry is not None:
+    return entry
+
+  # Check our database of available packages.
+  package_obj = Package.objects(name=package).first()
+  if not package_obj:
+    return None
+
+  # Find a matching version.
+  if selector is None:
+    best = package_obj.latest
+  else:
+    best = PackageVersion.find_best(package_obj, selector)
+  if not best:
+    return None
+
+  # The ETag and date cover the files as well, additional files may be
+  # uploaded to a version without changing its manifest.
+  etag = best.manifest_hash or models.manifest_hash(best.manifest)
+  if best.files:
+    etag = models.manifest_hash(etag + ''.join(x.sha256 for x in best.files))
+  modified = best.get_modified().astimezone(timezone.utc).replace(microsecond=0)
+  if is_fresh is not None and is_fresh(etag, modified):
+    return {'etag': etag, 'modified': modified}
+
+  try:
+    manifest = json.loads(best.manifest)
+  except json.JSONDecodeError:
+    app.logger.error("invalid manifest found: {}@{}".format(best.package.name, best.version))
+    flask.abort(505)
+
+  # The URLs are relative, the entry is shared by requests to all hosts.
+  ref = refstring.parse(package).package
+  files = []
+  for file in best.files:
+    data = file.to_json()
+    data['url'] = flask.url_for('download', scope=ref.scope, package=ref.name,
+        version=best.version, filename=file.name)
+    files.append(data)
+
+  entry = {
+    'manifest': manifest,
+    'dist': {'files': files},
+    'etag': etag,
+    'modified': modified
+  }
+  findcache.put(package, selector, entry)
+  return entry
+
+
+def find_manifest(package, selector):
+  entry = find_version(package, selector)
+  return entry['manifest'] if entry else None
+
+
+def not_modified(etag, modified):
+  """
+  Returns True if the client's `If-None-Match` or, if that header is not
+  present, `If-Modified-Since` header matches the specified *etag* and
+  *modified* date.
+  """
+
+  if request.if_none_match:
+    return request.if_none_match.contains(etag)
+  since = request.if_modified_since
+  if since is not None:
+    if since.tzinfo is None:
+      since = since.replace(tzinfo=timezone.utc)
+    return modified <= since
+  return False
+
+
 class FindPackage(Resource):
 
   def get(self, package, version, scope=None):
@@ -74,24 +170,20 @@ class FindPackage(Resource):
     except ValueError as exc:
       flask.abort(404)
 
-    # Check our database of available packages.
-    package_obj = Package.objects(name=package).first()
-    if not package_obj:
-      return self.not_found(package, version)
-
-    # Find a matching version.
-    versions = PackageVersion.objects(package=package_obj)
-    key = lambda x: semver.Version(x.version)
-    best = version.best_of(versions, key=key)
-
-    if not best:
+    entry = find_version(package, version, not_modified)
+    if entry is None:
       return self.not_found(package, version)
 
-    try:
-      return json.loads(best.manifest)
-    except json.JSONDecodeError:
-      app.logger.error("invalid manifest found: {}@{}".format(best.package.name, best.version))
-      flask.abort(505)
+    headers = {'ETag': '"{}"'.format(entry['etag']),
+               'Last-Modified': http_date(entry['modified'])}
+    if not_modified(entry['etag'], entry['modified']):
+      return flask.Response(status=304, headers=headers)
+    # Like the npm registry, the `dist` information is sent alongside the
+    # manifest fields so that clients can verify their downloads.
+    result = dict(entry['manifest'])
+    result['dist'] = {'files': [dict(x, url=urllib.parse.urljoin(request.host_url, x['url']))
+                                for x in entry['dist']['files']]}
+    return result, 200, headers
 
   def not_found(self, package, version):
     return {'error': {
@@ -101,18 +193,248 @@ class FindPackage(Resource):
     }}, 404
 
 
+class ResolveTree(Resource):
+  """
+  Resolves the full dependency tree of the packages specified in the
+  `packages` list of the JSON request body, eg.
+  `{"packages": ["@scope/foo@~1.2.0", "bar@1.x"]}`.
+  """
+
+  def post(self):
+    data = request.get_json(silent=True) or {}
+    roots = data.get('packages')
+    if not isinstance(roots, list) or not roots:
+      return bad_request('expected a non-empty "packages" list')
+
+    resolver = DependencyResolver(find_manifest, config.resolve_max_packages)
+    result = {}
+    for root in roots:
+      try:
+        ref = refstring.parse(root)
+      except (TypeError, ValueError) as exc:
+        return bad_request('invalid package reference "{}": {}'.format(root, exc))
+      if not ref.package:
+        return bad_request('invalid package reference "{}"'.format(root))
+      try:
+        result[root] = resolver.resolve(str(ref.package), ref.version)
+      except PackageNotFound as exc:
+        return _error('Package not found', str(exc), 404)
+      except ResolveError as exc:
+        return bad_request(str(exc))
+
+    return {'roots': result, 'packages': resolver.packages,
+            'cycles': resolver.cycles}
+
 
 class Download(Resource):
   """
-  Note: Serving files should usually be performed by a real web server like
-  NGinx or Apache. This API call is only available for development purposes.
+  Serves the files of a package version. Depending on `config.download`,
+  the file is sent by Flask or the request is handed to the fronting web
+  server with an `X-Accel-Redirect` (NGinx) or `X-Sendfile` (Apache,
+  Lighttpd) header.
   """
 
   def get(self, package, version, filename, scope=None):
     package = str(refstring.Package(scope, package))
-    directory = os.path.join(config.prefix, package, version)
-    directory = os.path.normpath(os.path.abspath(directory))
-    return flask.send_from_directory(directory, filename)
+    package_obj = Package.objects(name=package).first()
+    if not package_obj:
+      flask.abort(404)
+    pkgversion = PackageVersion.objects(package=package_obj, version=version) \
+        .only('files').first()
+    entry = pkgversion.get_file(filename) if pkgversion else None
+    if not entry:
+      flask.abort(404)
+    path = entry.get_path()
+
+    mode = config.download['mode']
+    if mode == 'x-accel-redirect':
+      response = flask.Response()
+      response.headers['X-Accel-Redirect'] = '/'.join([
+          config.download['accel_prefix'].rstrip('/'),
+          os.path.relpath(path, blobstore.store.directory).replace(os.sep, '/')])
+    elif mode == 'x-sendfile':
+      response = flask.Response()
+      response.headers['X-Sendfile'] = path
+    elif mode == 'flask':
+      if not os.path.isfile(path):
+        flask.abort(404)
+      response = flask.send_file(path)
+    else:
+      raise ValueError('invalid config.download mode: {!r}'.format(mode))
+
+    response.headers['Content-Disposition'] = 'attachment; ' \
+        'filename*=UTF-8\'\'{}'.format(urllib.parse.quote(filename))
+
+    # The file behind this URL can be replaced with `force`, thus caches
+    # must revalidate it. The ETag is the digest of the content, unchanged
+    # files are answered with 304.
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.set_etag(entry.sha256)
+
+    # Range requests are answered only after the ETag is set, a resuming
+    # client sends the digest in its `If-Range` header.
+    if mode == 'flask':
+      return response.make_conditional(request, accept_ranges=True,
+          complete_length=entry.size)
+    return response.make_conditional(request)
+
+
+def check_upload_access(package):
+  """
+  Checks whether the authenticated user may upload files to the
+  #refstring.Package *package*. Returns a tuple of the #User and an error
+  response, one of which is None.
+  """
+
+  # Find the authenticated user. We should always get one because we
+  # use the same mechanism in httpauth.
+  user = User.objects(name=httpauth.username()).first()
+  if not user.validated:
+    return None, email_not_verified(user)
+
+  if config.enforce_package_namespaces and \
+      package.scope != user.name and not user.superuser:
+    return None, bad_request('You can only upload packages into your own namespace. '
+      ' Rename your package to "@{}/{}"'.format(user.name, package.name))
+
+  pkg = Package.objects(name=str(package)).first()
+  if pkg and pkg.owner != user:
+    return None, unauthorized_access(user, pkg)
+
+  return user, None
+
+
+def check_upload_file(pkgversion, filename, force):
+  """
+  Returns an error response if *filename* can not be uploaded to the
+  #PackageVersion *pkgversion* (which may be None), otherwise None.
+  """
+
+  if filename == 'package.json':
+    return bad_request('"package.json" can not be uploaded directly')
+  if pkgversion and pkgversion.get_file(filename) and not force:
+    return bad_request('file "{} already exists'.format(filename))
+  return None
+
+
+def find_package_version(package, version):
+  pkg = Package.objects(name=str(package)).first()
+  if not pkg:
+    return None, None
+  return pkg, PackageVersion.objects(package=pkg, version=str(version)).first()
+
+
+def store_upload(user, package, version, filename, sink, force):
+  """
+  Validates the file *filename* that was received into the
+  #ingest.UploadSink *sink* and adds it to the package version. Returns
+  the response for the upload request.
+  """
+
+  # Find the package information in our database.
+  pkg, pkgversion = find_package_version(package, version)
+  error = check_upload_file(pkgversion, filename, force)
+  if error:
+    return error
+
+  replies = []
+  writer = sink.writer
+
+  # Handle package source distributions special: The package.json and
+  # README.md files were extracted while receiving the archive, store the
+  # information in the database.
+  if filename == registry_client.get_package_archive_name(package, version):
+    if sink.sniffer.error:
+      return bad_request('The uploaded package distribution archive is '
+          'invalid: {}'.format(sink.sniffer.error))
+    try:
+      files = {k: v.decode('utf8') for k, v in sink.sniffer.files.items()}
+    except UnicodeDecodeError as exc:
+      return bad_request('The uploaded package distribution archive '
+          'contains invalid UTF-8 data: {}'.format(exc))
+
+    if 'package.json' not in files:
+      return bad_request('The uploaded package distribution archive does '
+          'not container a package.json file')
+
+    # Parse the manifest.
+    try:
+      pkgmf_json = json.loads(files['package.json'])
+      pkgmf = manifest.parse_dict(pkgmf_json)
+    except (json.JSONDecodeError, manifest.InvalidPackageManifest) as exc:
+      return bad_request('Invalid package manifest: {}'.format(exc))
+    if not pkgmf.license:
+      return bad_request('Packages uploaded to the registry must specify '
+          'the `license` field.')
+    if pkgmf.name != str(package) or pkgmf.version != version:
+      return bad_request('The uploaded package distribution achive does '
+          'not match with the target version. You are trying to uploaded '
+          'the archive to "{}@{}" but the manifest says it is actually '
+          '"{}".'.format(package, version, pkgmf.identifer))
+
+    # Now that we validated the archive and its manifest, we can move
+    # it to its final location.
+    sha256, size = writer.commit(acquire=models.Blob.acquire)
+
+    # If the package did not exist yet, make sure it exists in the
+    # database.
+    if not pkg:
+      replies.append('Added package "{}" to user "{}"'.format(package, user.name))
+      pkg = Package(name=str(package), owner=user)
+      pkg.save()
+      suggest.add(pkg.name)
+      suggest.notify()
+
+    # Same for the version.
+    if not pkgversion:
+      replies.append('Added new package version "{}"'.format(pkgmf.identifier))
+      pkgversion = PackageVersion(package=pkg, version=str(version))
+      change_type = 'publish'
+    else:
+      replies.append('Updated package version "{}"'.format(pkgmf.identifier))
+      change_type = 'update'
+    pkgversion.readme = files.get('README.md', '')
+    pkgversion.render_readme()
+    pkgversion.manifest = files['package.json']
+    replaced = pkgversion.add_file(filename, sha256, writer.sha512, size)
+    pkgversion.save()
+    findcache.invalidate(package)
+    findcache.notify()
+
+    # Update the 'latest' member in the Package.
+    if pkg.update_latest(pkgversion):
+      replies.append('{} is now the newest version of package "{}"'.format(
+          pkgversion.version, pkg.name))
+    pkg.update_summary()
+    search.update_package(pkg)
+
+  # This does not appear to be a package distribution archive.
+  # We only allow additional files after a distribution was uploaded
+  # at least once.
+  else:
+    if not pkgversion:
+      return bad_request('Additional file uploads are only allowed after '
+          'a package distribution was uploaded at least once.')
+
+    if pkgversion.get_file(filename):
+      replies.append('File "{}" updated.'.format(filename))
+    else:
+      replies.append('File "{}" saved.'.format(filename))
+
+    sha256, size = writer.commit(acquire=models.Blob.acquire)
+    pkgmf = None
+    change_type = 'file'
+    replaced = pkgversion.add_file(filename, sha256, writer.sha512, size)
+    pkgversion.save()
+    findcache.invalidate(package)
+    findcache.notify()
+
+  export.update_package(pkg)
+  changes.record(change_type, pkg.name, version, filename, user.name)
+  if replaced:
+    models.Blob.release(replaced.sha256)
+
+  return {'message': '\n'.join(replies)}
 
 
 class Upload(Resource):
@@ -127,128 +449,245 @@ class Upload(Resource):
     except ValueError:
       flask.abort(404)
 
-    replies = []
+    user, error = check_upload_access(package)
+    if error:
+      return error
 
-    # Find the authenticated user. We should always get one because we
-    # use the same mechanism in httpauth.
-    user = User.objects(name=httpauth.username()).first()
-    if not user.validated:
-      return email_not_verified(user)
-
-    if config.enforce_package_namespaces and \
-        package.scope != user.name and not user.superuser:
-      return bad_request('You can only upload packages into your own namespace. '
-        ' Rename your package to "@{}/{}"'.format(user.name, package.name))
-
-    # Find the package information in our database.
-    pkg = Package.objects(name=str(package)).first()
-    if pkg and pkg.owner != user:
-      return unauthorized_access(user, pkg)
-    pkgversion = PackageVersion.objects(package=pkg, version=str(version)).first()
+    # Every file part is received into a temporary file. They are deleted
+    # unless committed, also if the request has too many files or parsing
+    # it fails, eg. because the client disconnected.
+    finally_.append(request.close_sinks)
 
     # We only expect 1 file to be uploaded per request.
     if len(request.files) != 1:
       return bad_request('zero or more than 1 file(s) uploaded')
     filename, storage = next(request.files.items())
-    if filename == 'package.json':
-      return bad_request('"package.json" can not be uploaded directly')
-
-    # Get the directory and filename to upload the file to.
-    directory = os.path.join(config.prefix, str(package), str(version))
-    absfile = os.path.join(directory, filename)
 
     # Check if the upload should be forced even if the file already exists.
     force = request.args.get('force', 'false').lower().strip() == 'true'
-    if os.path.isfile(absfile) and not force:
-      return bad_request('file "{} already exists'.format(filename))
-
-    # Handle package source distributions special: Unpack the package.json
-    # and README.md file and store the information in the database.
-    if filename == registry_client.get_package_archive_name(package, version):
-      # Save the uploaded file to a temporary path. Make sure it gets
-      # deleted when we're done with the request.
-      tmp = tempfile.NamedTemporaryFile(suffix='_' + filename, delete=False)
-      tmp.close()
-      finally_.append(lambda: fs.silentremove(tmp.name))
-      storage.save(tmp.name)
-
-      # Extract the package.json and README.md files.
-      files = {}
-      with tarfile.open(tmp.name, mode='r') as tar:
-        for fn in ['package.json', 'README.md']:
-          try:
-            files[fn] = tar.extractfile(fn).read().decode('utf8')
-          except KeyError:
-            pass
-
-      if 'package.json' not in files:
-        return bad_request('The uploaded package distribution archive does '
-            'not container a package.json file')
-
-      # Parse the manifest.
-      try:
-        pkgmf_json = json.loads(files['package.json'])
-        pkgmf = manifest.parse_dict(pkgmf_json)
-      except (json.JSONDecodeError, manifest.InvalidPackageManifest) as exc:
-        return bad_request('Invalid package manifest: {}'.format(exc))
-      if not pkgmf.license:
-        return bad_request('Packages uploaded to the registry must specify '
-            'the `license` field.')
-      if pkgmf.name != str(package) or pkgmf.version != version:
-        return bad_request('The uploaded package distribution achive does '
-            'not match with the target version. You are trying to uploaded '
-            'the archive to "{}@{}" but the manifest says it is actually '
-            '"{}".'.format(package, version, pkgmf.identifer))
-
-      # Now that we validated the archive and its manifest, we can copy
-      # it into our target directory.
-      if not os.path.isdir(directory):
-        os.makedirs(directory)
-      shutil.move(tmp.name, absfile)
-
-      # If the package did not exist yet, make sure it exists in the
-      # database.
-      if not pkg:
-        replies.append('Added package "{}" to user "{}"'.format(package, user.name))
-        pkg = Package(name=str(package), owner=user)
-        pkg.save()
-
-      # Same for the version.
-      if not pkgversion:
-        replies.append('Added new package version "{}"'.format(pkgmf.identifier))
-        pkgversion = PackageVersion(package=pkg, version=str(version))
-      else:
-        replies.append('Updated package version "{}"'.format(pkgmf.identifier))
-      pkgversion.readme = files.get('README.md', '')
-      pkgversion.manifest = files['package.json']
-      pkgversion.add_file(filename)
-      pkgversion.save()
-
-      # Update the 'latest' member in the Package.
-      if pkg.update_latest(pkgversion):
-        replies.append('{} is now the newest version of package "{}"'.format(
-            pkgversion.version, pkg.name))
-
-    # This does not appear to be a package distribution archive.
-    # We only allow additional files after a distribution was uploaded
-    # at least once.
-    else:
-      if not pkgversion:
-        return bad_request('Additional file uploads are only allowed after '
-            'a package distribution was uploaded at least once.')
 
-      if os.path.isfile(absfile):
-        replies.append('File "{}" updated.'.format(filename))
-      else:
-        replies.append('File "{}" saved.'.format(filename))
+    # The uploaded file was streamed into the blob store while it was
+    # received (see ingest.StreamingRequest). It only becomes visible when
+    # it is committed, otherwise it gets deleted when we're done with the
+    # request.
+    sink = ingest.sink_for(storage)
+    finally_.append(sink.close)
+    return store_upload(user, package, version, filename, sink, force)
+
+
+class CreateUploadSession(Resource):
+  """
+  Starts a chunked upload of the file specified with the `filename` query
+  parameter. The data is then sent with #UploadSessionData and the upload
+  is finished with #CommitUploadSession.
+  """
+
+  @httpauth.login_required
+  def post(self, package, version, scope=None):
+    try:
+      package = refstring.Package(scope, package)
+      version = semver.Version(version)
+    except ValueError:
+      flask.abort(404)
+
+    user, error = check_upload_access(package)
+    if error:
+      return error
+
+    filename = request.args.get('filename')
+    if not filename:
+      return bad_request('missing "filename" parameter')
+    force = request.args.get('force', 'false').lower().strip() == 'true'
+    error = check_upload_file(find_package_version(package, version)[1], filename, force)
+    if error:
+      return error
+
+    models.UploadSession.collect_garbage(config.upload_session_ttl)
+    session = models.UploadSession(user=user, package=str(package),
+        version=str(version), filename=filename, force=force)
+    session.save()
+    os.makedirs(config.upload_session_prefix, exist_ok=True)
+    open(session.get_path(), 'wb').close()
+    return {'session': str(session.id), 'offset': 0}
+
+
+def get_upload_session(session_id):
+  """
+  Returns the #UploadSession with the specified ID that belongs to the
+  authenticated user, or aborts with 404.
+  """
+
+  try:
+    session = models.UploadSession.objects(id=session_id).first()
+  except ValidationError:
+    session = None
+  if not session or session.user.name != httpauth.username():
+    flask.abort(404)
+  return session
+
+
+class UploadSessionData(Resource):
+  """
+  Use GET to retrieve the number of bytes received so far and PUT to send
+  the next chunk. The `offset` query parameter of a PUT request must match
+  the number of bytes received so far.
+  """
+
+  @httpauth.login_required
+  def get(self, session_id):
+    session = get_upload_session(session_id)
+    return {'session': str(session.id), 'offset': session.get_offset()}
+
+  @httpauth.login_required
+  def put(self, session_id):
+    session = get_upload_session(session_id)
+    current = session.get_offset()
+    try:
+      offset = int(request.args.get('offset', ''))
+    except ValueError:
+      return bad_request('missing or invalid "offset" parameter')
+    if offset != current:
+      return _error('Conflict', 'Expected offset {}'.format(current), 409)
+
+    with open(session.get_path(), 'ab') as fp:
+      while True:
+        chunk = request.stream.read(blobstore.CHUNK_SIZE)
+        if not chunk:
+          break
+        offset += len(chunk)
+        if offset > config.max_upload_size:
+          fp.truncate(current)
+          return _error('Request entity too large', 'The file exceeds the '
+              'maximum upload size of {} bytes'.format(config.max_upload_size), 413)
+        fp.write(chunk)
+
+    session.updated = datetime.now()
+    session.save()
+    return {'session': str(session.id), 'offset': offset}
+
+  @httpauth.login_required
+  def delete(self, session_id):
+    get_upload_session(session_id).delete()
+    return {'message': 'Upload session deleted.'}
+
+
+class CommitUploadSession(Resource):
+  """
+  Completes an upload session. The `sha256` or `sha512` query parameter
+  must match the digest of the received data. The file is then validated
+  and stored like with a normal #Upload.
+  """
+
+  @httpauth.login_required
+  @decorators.finally_(True)
+  def post(self, finally_, session_id):
+    session = get_upload_session(session_id)
+    finally_.append(session.delete)
+    package = refstring.parse(session.package).package
+    version = semver.Version(session.version)
+
+    user, error = check_upload_access(package)
+    if error:
+      return error
+
+    sink = ingest.UploadSink.from_file(session.get_path())
+    finally_.append(sink.close)
+    digests = sink.writer.digests()
+    expected = {k: request.args[k].lower() for k in digests if k in request.args}
+    if not expected:
+      return bad_request('missing "sha256" or "sha512" parameter')
+    for key, value in expected.items():
+      if digests[key] != value:
+        return bad_request('{} mismatch, the upload session is discarded'.format(key))
+
+    return store_upload(user, package, version, session.filename, sink, session.force)
+
 
-      # Simply save the file to the directory.
-      storage.save(absfile)
-      pkgmf = None
-      pkgversion.add_file(filename)
-      pkgversion.save()
+class FindCacheStats(Resource):
 
-    return {'message': '\n'.join(replies)}
+  def get(self):
+    return findcache.stats()
+
+
+def summary_json(summary):
+  return {'name': summary.name, 'owner': summary.owner_name,
+          'latest': summary.latest_version, 'description': summary.description,
+          'license': summary.license_id, 'versions': summary.version_count,
+          'created': summary.created.isoformat() if summary.created else None}
+
+
+class ListPackages(Resource):
+  """
+  Lists the packages in the registry. Supports the `sort` (name, newest,
+  versions), `limit` and `cursor` query parameters. The returned `cursor`
+  selects the next page and is null on the last page.
+  """
+
+  def get(self):
+    page = pagination.from_request(models.PackageSummary.objects(),
+        models.PackageSummary.ORDERS, 'name')
+    return {'packages': [summary_json(x) for x in page.items], 'cursor': page.cursor}
+
+
+class ListUsers(Resource):
+  """
+  Lists the users of the registry. Supports the `sort` (name, newest),
+  `limit` and `cursor` query parameters.
+  """
+
+  def get(self):
+    page = pagination.from_request(User.objects().only('name', 'created'),
+        User.ORDERS, 'name')
+    users = [{'name': x.name, 'created': x.created.isoformat()} for x in page.items]
+    return {'users': users, 'cursor': page.cursor}
+
+
+class ListUserPackages(Resource):
+  """
+  Lists the packages owned by a user, see #ListPackages.
+  """
+
+  def get(self, user):
+    user = User.objects(name=user).first()
+    if not user:
+      flask.abort(404)
+    page = pagination.from_request(models.PackageSummary.objects(owner_name=user.name),
+        models.PackageSummary.ORDERS, 'name')
+    return {'packages': [summary_json(x) for x in page.items], 'cursor': page.cursor}
+
+
+class ListVersions(Resource):
+  """
+  Lists the versions of a package. Supports the `sort` (version, newest),
+  `limit` and `cursor` query parameters.
+  """
+
+  def get(self, package, scope=None):
+    package = Package.objects(name=str(refstring.Package(scope, package))).first()
+    if not package:
+      flask.abort(404)
+    page = pagination.from_request(PackageVersion.objects(package=package)
+        .only('version', 'created', *PackageVersion.VERSION_FIELDS),
+        PackageVersion.ORDERS, 'version')
+    versions = [{'version': x.version, 'created': x.created.isoformat()} for x in page.items]
+    return {'versions': versions, 'cursor': page.cursor}
+
+
+class SearchSuggest(Resource):
+  """
+  Returns the names of packages that start with the `q` query parameter.
+  Scoped packages also match by their name without the scope.
+  """
+
+  def get(self):
+    try:
+      limit = max(1, min(int(request.args.get('limit', 10)), 100))
+    except ValueError:
+      return bad_request('invalid "limit" parameter')
+    query = request.args.get('q', '').strip()
+    if not query:
+      return {'packages': []}
+    return {'packages': suggest.get_index().find(query, limit)}
 
 
 class Register(Resource):
@@ -300,6 +739,154 @@ class Register(Resource):
     return {'message': message}
 
 
+def catalog_lines(since):
+  """
+  Yields a JSON line for every package version created at or after
+  *since* (which may be None). The versions are read with a server-side
+  cursor and only the fields of the line are loaded.
+  """
+
+  pipeline = []
+  if since is not None:
+    pipeline.append({'$match': {'created': {'$gte': since}}})
+  pipeline += [
+    {'$sort': {'created': 1, '_id': 1}},
+    {'$project': {'package': 1, 'version': 1, 'created': 1, 'manifest': 1,
+                  'files.name': 1, 'files.size': 1, 'files.sha256': 1,
+                  'files.sha512': 1}},
+    {'$lookup': {'from': Package._get_collection_name(), 'localField': 'package',
+                 'foreignField': '_id', 'as': 'package'}}
+  ]
+  cursor = PackageVersion._get_collection().aggregate(pipeline,
+      allowDiskUse=True, batchSize=500)
+  for obj in cursor:
+    if not obj['package']:
+      continue
+    try:
+      manifest = json.loads(obj['manifest']) if obj.get('manifest') else None
+    except ValueError:
+      manifest = None
+    line = {'package': obj['package'][0]['name'], 'version': obj['version'],
+            'created': obj['created'].isoformat(), 'manifest': manifest,
+            'files': obj.get('files', [])}
+    yield json.dumps(line, separators=(',', ':')) + '\n'
+
+
+class Catalog(Resource):
+  """
+  Streams all package versions as newline-delimited JSON, optionally only
+  the ones created at or after the `since` query parameter (an ISO 8601
+  date or date and time). The response is gzip compressed if the client
+  accepts it.
+  """
+
+  def get(self):
+    since = request.args.get('since')
+    if since:
+      for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+          since = datetime.strptime(since, fmt)
+          break
+        except ValueError:
+          pass
+      else:
+        return bad_request('invalid "since" parameter')
+    else:
+      since = None
+
+    use_gzip = 'gzip' in request.accept_encodings
+
+    def generate():
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if use_gzip else None
+      buffer = []
+      size = 0
+      for line in catalog_lines(since):
+        buffer.append(line.encode('utf8'))
+        size += len(buffer[-1])
+        if size >= blobstore.CHUNK_SIZE:
+          data = b''.join(buffer)
+          buffer, size = [], 0
+          data = compressor.compress(data) if compressor else data
+          if data:
+            yield data
+      data = b''.join(buffer)
+      if compressor:
+        data = compressor.compress(data) + compressor.flush()
+      if data:
+        yield data
+
+    response = flask.Response(generate(), mimetype='application/x-ndjson')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if use_gzip:
+      response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+class ListChanges(Resource):
+  """
+  Lists the changes to the registry with a sequence number greater than
+  the `since` query parameter, at most `limit`. If there are none, the
+  request waits up to `timeout` seconds for new changes. Continue with the
+  returned `last_seq` as `since`. `head` is the latest sequence number.
+  """
+
+  def get(self):
+    try:
+      since = max(int(request.args.get('since', 0)), 0)
+      limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+      timeout = min(max(float(request.args.get('timeout', 0)), 0),
+                    config.changes_poll_timeout)
+    except ValueError:
+      return bad_request('invalid "since", "limit" or "timeout" parameter')
+    result = changes.wait(since, limit, timeout)
+    return {'changes': [x.to_json() for x in result],
+            'last_seq': result[-1].seq if result else since,
+            'head': changes.last_seq()}
+
+
+def token_json(token):
+  return {'prefix': token.prefix, 'name': token.name,
+          'created': token.created.isoformat()}
+
+
+class ApiTokens(Resource):
+  """
+  Lists the API tokens of the authenticated user or creates a new one. The
+  token string is only returned once, on creation. Tokens are passed with
+  an `Authorization: Bearer <token>` header or as the Basic auth password.
+  """
+
+  @httpauth.login_required
+  def get(self):
+    user = User.objects(name=httpauth.username()).first()
+    tokens = models.ApiToken.objects(user=user).order_by('created')
+    return {'tokens': [token_json(x) for x in tokens]}
+
+  @httpauth.login_required
+  def post(self):
+    user = User.objects(name=httpauth.username()).first()
+    name = request.form.get('name')
+    if name is not None and len(name) > 64:
+      return bad_request('Token name is too long')
+    token, value = models.ApiToken.generate(user, name)
+    result = token_json(token)
+    result['token'] = value
+    return result
+
+
+class RevokeApiToken(Resource):
+
+  @httpauth.login_required
+  def delete(self, prefix):
+    user = User.objects(name=httpauth.username()).first()
+    token = models.ApiToken.objects(user=user, prefix=prefix).first()
+    if not token:
+      return _error('Not found', 'Token "{}" does not exist'.format(prefix), 404)
+    token.delete()
+    httpauth.invalidate()
+    return {'message': 'Token revoked.'}
+
+
 class Terms(Resource):
 
   def get(self):
@@ -307,11 +894,27 @@ class Terms(Resource):
     return {'terms': resources.load('TERMS.txt')}
 
 
-api.add_resource(FindPackage, '/api/find/<package>/<version>',
-                              '/api/find/@<scope>/<package>/<version>')
-api.add_resource(Download,    '/api/download/<package>/<version>/<filename>',
-                              '/api/download/@<scope>/<package>/<version>/<filename>')
-api.add_resource(Upload,      '/api/upload/<package>/<version>',
-                              '/api/upload/@<scope>/<package>/<version>')
-api.add_resource(Register,    '/api/register')
-api.add_resource(Terms,       '/api/terms', endpoint='api_terms')
+api.add_resource(FindPackage,    '/api/find/<package>/<version>',
+                                 '/api/find/@<scope>/<package>/<version>')
+api.add_resource(ResolveTree,    '/api/resolve')
+api.add_resource(FindCacheStats, '/api/find-cache')
+api.add_resource(Download,       '/api/download/<package>/<version>/<filename>',
+                                 '/api/download/@<scope>/<package>/<version>/<filename>')
+api.add_resource(Upload,         '/api/upload/<package>/<version>',
+                                 '/api/upload/@<scope>/<package>/<version>')
+api.add_resource(CreateUploadSession, '/api/upload/<package>/<version>/session',
+                                      '/api/upload/@<scope>/<package>/<version>/session')
+api.add_resource(UploadSessionData,   '/api/upload-session/<session_id>')
+api.add_resource(CommitUploadSession, '/api/upload-session/<session_id>/commit')
+api.add_resource(ListPackages,   '/api/packages')
+api.add_resource(ListVersions,   '/api/packages/<package>/versions',
+                                 '/api/packages/@<scope>/<package>/versions')
+api.add_resource(ListUsers,      '/api/users')
+api.add_resource(ListUserPackages, '/api/users/<user>/packages')
+api.add_resource(SearchSuggest,  '/api/search/suggest')
+api.add_resource(ListChanges,    '/api/changes')
+api.add_resource(Catalog,        '/api/catalog.ndjson')
+api.add_resource(ApiTokens,      '/api/tokens')
+api.add_resource(RevokeApiToken, '/api/tokens/<prefix>')
+api.add_resource(Register,       '/api/register')
+api.add_resource(Terms,          '/api/terms', endpoint='api_terms')
@@ -18,39 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import collections
 import os
-import yaml
 from flask import abort, request, render_template
 
 import app from '../app'
-import markdown from '../markdown'
+import docpages from '../docpages'
 
-basedir = os.path.join(app.root_path, '_vendor/nodepy/docs')
-pages = require(os.path.join(basedir, '_pages.json'))
-
-
-def find_page(path):
-  def recursion(pages):
-    for p in pages:
-      if p['path'] == path: return p
-      s = recursion(p.get('subs', []))
-      if s: return s
-    return None
-  return recursion(pages)
+docpages.load()
 
 
 @app.route('/docs')
 @app.route('/docs/<path:path>')
 def docs(path=None):
   # Find the active page.
-  page = find_page(path)
+  page = docpages.find_page(path)
   if not page: abort(404)
 
-  filename = os.path.join(basedir, page['file'])
-  with open(filename, 'r') as fp:
-    md = markdown()
-    content = md.convert(fp.read())
-
+  content, toc = docpages.get_page(path, check_mtime=app.debug)
   return render_template('registry/docs.html',
-    content=content, toc=md.toc, pages=pages, active_page=path, page=page)
+    content=content, toc=toc, pages=docpages.pages, active_page=path, page=page)
@@ -23,6 +23,8 @@ import yaml
 from flask import abort, redirect, request, render_template, Response
 
 import app from '../app'
+import pagination from '../pagination'
+import search from '../search'
 import models, {User, Package, PackageVersion} from '../models'
 import refstring from '@nodepy/nppm/lib/refstring'
 
@@ -52,9 +54,33 @@ def __browse_users__backwards_compat(**kwargs):
   return redirect(request.path.replace('/browse', ''))
 
 
+SEARCH_PAGE_SIZE = 20
+
+
 @app.route('/packages')
 def packages():
-  return render_template('registry/browse/index.html', nav='packages')
+  query = request.args.get('q', '').strip()
+  if query:
+    return search_packages(query)
+  page = pagination.from_request(models.PackageSummary.objects(),
+      models.PackageSummary.ORDERS, 'name')
+  return render_template('registry/browse/index.html', nav='packages',
+      page=page)
+
+
+def search_packages(query):
+  try:
+    page = max(1, int(request.args.get('page', 1)))
+  except ValueError:
+    abort(400)
+  results = search.get_index().search(query)
+  offset = (page - 1) * SEARCH_PAGE_SIZE
+  names = [name for name, score in results[offset:offset + SEARCH_PAGE_SIZE]]
+  summaries = {x.name: x for x in models.PackageSummary.objects(name__in=names)}
+  packages = [summaries[name] for name in names if name in summaries]
+  return render_template('registry/browse/search.html', nav='packages',
+      query=query, packages=packages, page=page, total=len(results),
+      has_next=offset + SEARCH_PAGE_SIZE < len(results))
 
 
 @app.route('/packages/<package>')
@@ -71,13 +97,17 @@ def package(package, scope=None, version=None):
       abort(404)
   else:
     version = package.latest
+  versions = pagination.from_request(PackageVersion.objects(package=package)
+      .exclude(*PackageVersion.README_FIELDS), PackageVersion.ORDERS, 'version')
   return render_template('registry/browse/package.html',
-      package=package, version=version, nav='packages')
+      package=package, version=version, versions=versions, nav='packages')
 
 
 @app.route('/users')
 def users():
-  return render_template('registry/browse/users.html', nav='users')
+  page = pagination.from_request(User.objects().only('name', 'created'),
+      User.ORDERS, 'name')
+  return render_template('registry/browse/users.html', nav='users', page=page)
 
 
 @app.route('/users/<user>')
@@ -85,7 +115,10 @@ def user(user):
   user = User.objects(name=user).first()
   if not user:
     abort(404)
-  return render_template('registry/browse/user.html', user=user, nav='users')
+  page = pagination.from_request(models.PackageSummary.objects(owner_name=user.name),
+      models.PackageSummary.ORDERS, 'name')
+  return render_template('registry/browse/user.html', user=user, page=page,
+      nav='users')
 
 
 @app.route('/email/validate/<token>')
@@ -19,13 +19,27 @@
 # THE SOFTWARE.
 
 import click
+import collections
 import os
+import pymongo
+import re
 import shutil
 import sys
 
+import blobstore from './lib/blobstore'
 import models from './lib/models'
+import changes from './lib/changes'
+import docpages from './lib/docpages'
+import { drop_versions } from './lib/drop'
+import export from './lib/export'
+import findcache from './lib/findcache'
+import search from './lib/search'
+import suggest from './lib/suggest'
+import markdown from './lib/markdown'
+import parallel from './lib/parallel'
+import queryreport from './lib/queryreport'
+import utils from './lib/utils'
 import semver from 'nppm/lib/semver'
-import refstring from 'nppm/lib/refstring'
 import config from './config'
 
 
@@ -43,19 +57,94 @@ def prompt(question):
 def main(): pass
 
 
+def glob_regex(pattern):
+  """
+  Converts the glob *pattern* to an anchored regular expression. `*` and
+  `?` do not match `/`, thus `@foo*` matches scopes only and `foo-*` does
+  not match scoped packages.
+  """
+
+  parts = []
+  for char in pattern:
+    if char == '*':
+      parts.append('[^/]*')
+    elif char == '?':
+      parts.append('[^/]')
+    else:
+      parts.append(re.escape(char))
+  return '^' + ''.join(parts) + '$'
+
+
+def find_packages(pattern):
+  """
+  Returns the packages matching *pattern*, which is a package name, a
+  glob pattern like `foo-*` or `@scope/*`, or a scope like `@scope`.
+  """
+
+  if pattern.startswith('@') and '/' not in pattern:
+    pattern += '/*'
+  if not any(c in pattern for c in '*?'):
+    return list(models.Package.objects(name=pattern))
+  # The regex is anchored and starts with the literal prefix of the
+  # pattern, thus MongoDB can use the index on the name.
+  regex = re.compile(glob_regex(pattern))
+  return [x for x in models.Package.objects(name=regex) if regex.match(x.name)]
+
+
+def parse_drop_pattern(pattern):
+  """
+  Splits a `<package>[@<selector>]` argument of `manage drop`. The package
+  may be a glob pattern, thus it is not parsed with #refstring.
+  """
+
+  name, sep, selector = pattern[1:].partition('@')
+  name = pattern[0] + name
+  return name, semver.Selector(selector) if sep else None
+
+
+def blob_sizes(files, digests):
+  sizes = {}
+  for entry in files:
+    if entry.sha256 in digests and entry.sha256 not in sizes:
+      size = entry.size
+      if size is None:
+        try:
+          size = os.path.getsize(entry.get_path())
+        except FileNotFoundError:
+          size = 0
+      sizes[entry.sha256] = size
+  return sum(sizes.values())
+
+
 @main.command()
 @click.option('--all', is_flag=True, help='Drop everything we have.')
-@click.option('-p', '--package', help='Drop a package and the selected versions from the registry.')
+@click.option('-p', '--package', multiple=True, help='Drop a package and the '
+    'selected versions from the registry. Can be a glob pattern like '
+    '"@scope/*" (where * does not match /) or a scope and can be specified '
+    'multiple times.')
 @click.option('-u', '--user', help='Drop a user from the registry, reowning his/her packages.')
 @click.option('--reown', help='The name of the packages new owner when dropping a user.')
 @click.option('--yes', is_flag=True, help='Don\'t ask for confirmation.')
 @click.option('--keep-files', is_flag=True, help='Keep the files in the registry data directory.')
-def drop(all, package, user, reown, yes, keep_files):
+@click.option('--dry-run', is_flag=True, help='Only report what would be dropped.')
+@click.option('-j', '--jobs', type=int, default=8, help='Number of threads for deleting files.')
+def drop(all, package, user, reown, yes, keep_files, dry_run, jobs):
   """
   Drop the registry data, a specific package or user.
   """
 
   if all:
+    if dry_run:
+      for cls in (models.User, models.Package, models.PackageVersion,
+                  models.PackageSummary, models.Blob, models.ApiToken,
+                  models.Change, models.MigrationRevision):
+        print('Would drop collection: {} ({} documents)'.format(
+            cls._get_collection_name(), cls.objects().count()))
+      if not keep_files and os.path.isdir(config.prefix):
+        size = sum(os.path.getsize(os.path.join(root, f))
+                   for root, dirs, files in os.walk(config.prefix) for f in files)
+        print('Would delete registry data directory ({})'.format(utils.sizeof_fmt(size)))
+      sys.exit(0)
     if not yes and not prompt('Are you sure you want to drop all data?'):
       sys.exit(0)
     print('Dropping collection: user')
@@ -66,6 +155,18 @@ def drop(all, package, user, reown, yes, keep_files):
     models.PackageVersion.drop_collection()
     print('Dropping collection: migration_revision')
     models.MigrationRevision.drop_collection()
+    findcache.notify()
+    suggest.notify()
+    print('Dropping collection: blob')
+    models.Blob.drop_collection()
+    print('Dropping collection: package_summary')
+    models.PackageSummary.drop_collection()
+    print('Dropping collection: api_token')
+    models.ApiToken.drop_collection()
+    # The sequence counter is kept, so that followers of the change log
+    # never see a sequence number twice.
+    print('Dropping collection: change')
+    models.Change.drop_collection()
     if not keep_files:
       print('Deleting registry data directory ...')
       if os.path.isdir(config.prefix):
@@ -73,55 +174,57 @@ def drop(all, package, user, reown, yes, keep_files):
     sys.exit(0)
 
   if package:
-    ref = refstring.parse(package)
-    package = models.Package.objects(name=str(ref.package)).first()
-    if not package:
-      print('Package "{}" does not exist.'.format(ref.package))
-      sys.exit(1)
-    versions = []
-    for pkgv in models.PackageVersion.objects(package=package):
-      if not ref.version or ref.version(semver.Version(pkgv.version)):
-        versions.append(pkgv)
-    if ref.version and not versions:
-      print('No versions matching "{}@{}"'.format(ref.package, ref.version))
+    # Collect the packages and versions matching all patterns. Packages
+    # are dropped entirely unless a version selector is specified.
+    packages = collections.OrderedDict()
+    for pattern in package:
+      name, selector = parse_drop_pattern(pattern)
+      matches = find_packages(name)
+      if not matches:
+        print('No packages matching "{}".'.format(name))
+        sys.exit(1)
+      for pkg in matches:
+        versions = [x for x in models.PackageVersion.objects(package=pkg).only('version', 'files')
+                    if not selector or selector(semver.Version(x.version))]
+        if selector and not versions:
+          continue
+        entry = packages.setdefault(pkg.name, {'package': pkg, 'versions': {}, 'all': False})
+        entry['versions'].update((x.id, x) for x in versions)
+        entry['all'] = entry['all'] or not selector
+    if not packages:
+      print('No versions matching {}.'.format(', '.join(package)))
       sys.exit(1)
-    if ref.version:
-      if yes:
-        print('Dropping the following versions of "{}"'.format(ref.package))
+
+    for entry in packages.values():
+      total = models.PackageVersion.objects(package=entry['package']).count()
+      entry['all'] = entry['all'] or len(entry['versions']) == total
+
+    versions = [v for x in packages.values() for v in x['versions'].values()]
+    dropped = [x['package'] for x in packages.values() if x['all']]
+    print('{} package(s) and {} version(s):'.format(len(dropped), len(versions)))
+    for name, entry in packages.items():
+      if entry['all']:
+        print('  - {} (all versions)'.format(name))
       else:
-        print('Are you sure you want to drop the following versions of "{}"?'
-            .format(ref.package))
-      for pkgv in versions:
-        print('  -', pkgv.version)
-      if not yes and not prompt('Confirm? '):
-        sys.exit(0)
-      print('Dropping "{}@{}" ...'.format(ref.package, ref.version))
-    else:
-      if not yes and not prompt('Do you really want to drop "{}" and all its versions?'
-          .format(ref.package)):
-        sys.exit(0)
-      print('Dropping "{}" ...'.format(ref.package))
-
-    for pkgv in versions:
-      directory = pkgv.get_directory()
-      pkgv.delete()
-      if not keep_files:
-        try:
-          shutil.rmtree(directory)
-        except OSError as exc:
-          print('  Warning: error deleting files for "{}@{}": {}'
-              .format(ref.package, pkgv.version, exc))
-          continue
+        print('  - {}@{}'.format(name, ', '.join(sorted(x.version for x in entry['versions'].values()))))
+
+    files = [f for v in versions for f in v.files]
+    digests = [f.sha256 for f in files]
+    if dry_run:
+      freed = models.Blob.release_many(digests, dry=True) if not keep_files else []
+      print('Would delete {} package version(s), {} package(s) and {} file(s) ({})'
+          .format(len(versions), len(dropped), len(freed),
+                  utils.sizeof_fmt(blob_sizes(files, set(freed)))))
+      sys.exit(0)
+    if not yes and not prompt('Do you really want to drop these?'):
+      sys.exit(0)
 
-    if not ref.version:
-      directory = package.get_directory()
-      package.delete()
-      if not keep_files:
-        try:
-          shutil.rmtree(directory)
-        except OSError as exc:
-          print('  Warning: error deleting files for "{}": {}'
-              .format(ref.package, exc))
+    freed = drop_versions([(x['package'], list(x['versions'].values()), x['all'])
+                           for x in packages.values()], keep_files, jobs)
+    if not keep_files:
+      print('Deleted {} file(s).'.format(freed))
+    print('Dropped {} package version(s) and {} package(s).'.format(len(versions), len(dropped)))
+    if not user:
       sys.exit(0)
 
   if user:
@@ -129,12 +232,16 @@ def drop(all, package, user, reown, yes, keep_files):
     if not user_obj:
       print('User "{}" does not exist.'.format(user))
       sys.exit(1)
+    packages = models.Package.objects(owner=user_obj)
+    count = packages.count()
+    if dry_run:
+      print('Would drop user "{}" and transfer {} package(s).'.format(user, count))
+      sys.exit(0)
     if not yes and not prompt('Do you really want to drop user "{}"?'.format(user)):
       sys.exit(0)
 
-    packages = models.Package.objects(owner=user_obj).all()
-    if not reown and packages:
-      reown = input('Which user should the {} packages be transfered to? '.format(len(packages)))
+    if not reown and count:
+      reown = input('Which user should the {} packages be transfered to? '.format(count))
     if reown:
       reown_obj = models.User.objects(name=reown).first()
       if not reown_obj:
@@ -143,15 +250,19 @@ def drop(all, package, user, reown, yes, keep_files):
       if reown_obj == user_obj:
         print('Target user can not match the user that will be dropped.')
         sys.exit(1)
-    if packages and not reown:
+    if count and not reown:
       print('Please specify a user the will own the users packages with --reown')
       sys.exit(1)
 
-    if packages:
-      print('Transferring packages ...')
-    for package in packages:
-      package.owner = reown_obj
-      package.save()
+    if count:
+      print('Transferring {} package(s) ...'.format(count))
+      ids = list(packages.scalar('id'))
+      packages.update(set__owner=reown_obj)
+      models.PackageSummary.objects(owner_name=user_obj.name) \
+          .update(set__owner_name=reown_obj.name)
+      for pkg in models.Package.objects(id__in=ids):
+        export.update_package(pkg)
+        changes.record('transfer', pkg.name, user=reown_obj.name)
 
     print('Dropping user "{}" ...'.format(user))
     user_obj.delete()
@@ -234,19 +345,242 @@ def demote(username):
     return 1
 
 
+@main.command('create-token')
+@click.argument('username')
+@click.option('-n', '--name', help='A name to identify the token.')
+def create_token(username, name):
+  """
+  Creates an API token for a user.
+  """
+
+  user = models.User.objects(name=username).first()
+  if not user:
+    print('User "{}" does not exist.'.format(username))
+    return 1
+  token, value = models.ApiToken.generate(user, name)
+  print(value)
+
+
+@main.command('list-tokens')
+@click.argument('username')
+def list_tokens(username):
+  """
+  Lists the API tokens of a user.
+  """
+
+  user = models.User.objects(name=username).first()
+  if not user:
+    print('User "{}" does not exist.'.format(username))
+    return 1
+  for token in models.ApiToken.objects(user=user).order_by('created'):
+    print('{}  {}  {}'.format(token.prefix, token.created.isoformat(), token.name or ''))
+
+
+@main.command('revoke-token')
+@click.argument('prefix')
+def revoke_token(prefix):
+  """
+  Revokes an API token by its prefix.
+  """
+
+  token = models.ApiToken.objects(prefix=prefix).first()
+  if not token:
+    print('Token "{}" does not exist.'.format(prefix))
+    return 1
+  token.delete()
+  print('Token revoked.')
+
+
+@main.command('ensure-indexes')
+@click.option('--foreground', is_flag=True, help='Build the indexes in the '
+    'foreground, which is faster but blocks the collections.')
+def ensure_indexes(foreground):
+  """
+  Creates the database indexes declared by the models.
+  """
+
+  created = models.ensure_indexes(background=not foreground)
+  for collection, name in created:
+    print('Created index "{}" on "{}".'.format(name, collection))
+  print('{} index(es) created.'.format(len(created)))
+
+
+@main.command('query-report')
+def query_report():
+  """
+  Explains the queries of the registry and flags collection scans and
+  in-memory sorts.
+  """
+
+  problems = 0
+  for desc, collection, result in queryreport.report():
+    flags = []
+    if result['collscan']:
+      flags.append('COLLSCAN')
+    if result['sort']:
+      flags.append('SORT')
+    problems += bool(flags)
+    print('{:<6} {:<28} {:<16} {}'.format('!!' if flags else 'ok', desc, collection,
+        ' '.join(flags) or ', '.join(result['indexes'])))
+  if problems:
+    print('{} query shape(s) are not supported by an index, run '
+        '`manage ensure-indexes`.'.format(problems))
+    sys.exit(1)
+
+
+@main.command('export-index')
+@click.option('-o', '--output', help='The output directory. Defaults to '
+    '`export_dir` in config.py')
+def export_index(output):
+  """
+  Exports the metadata of all packages as static JSON files.
+  """
+
+  output = output or config.export_dir
+  if not output:
+    print('No output directory specified and `export_dir` is not set.')
+    sys.exit(1)
+  count = export.export(output)
+  print('Exported {} package(s) to "{}".'.format(count, output))
+
+
+@main.command()
+@click.argument('source')
+@click.option('-j', '--jobs', type=int, default=4, help='Number of concurrent downloads.')
+@click.option('--full', is_flag=True, help='Compare all packages instead of '
+    'following the change log from the last checkpoint.')
+@click.option('--verify', is_flag=True, help='Check afterwards that every '
+    'version of the source is mirrored with the same files.')
+def mirror(source, jobs, full, verify):
+  """
+  Mirrors the packages of another registry instance at SOURCE.
+  """
+
+  # Loaded only here as it imports the application.
+  mirror_lib = require('./lib/mirror')
+  mirror = mirror_lib.Mirror(source, jobs=jobs)
+  try:
+    mirror.run(full=full)
+  except mirror_lib.MirrorError as exc:
+    print('error:', exc)
+    sys.exit(1)
+  stats = mirror.stats
+  print('Mirrored {} version(s), {} file(s) ({}), skipped {} file(s), dropped {} version(s).'
+      .format(stats['versions'], stats['files'], utils.sizeof_fmt(stats['bytes']),
+              stats['skipped'], stats['dropped']))
+
+  if verify:
+    try:
+      count, problems = mirror.verify()
+    except mirror_lib.MirrorError as exc:
+      print('error:', exc)
+      sys.exit(1)
+    for problem in problems:
+      print('  ' + problem)
+    print('Verified {} version(s), {} problem(s).'.format(count, len(problems)))
+    if problems:
+      sys.exit(1)
+
+
+@main.command('gc-uploads')
+@click.option('--max-age', type=int, help='The maximum age of an upload '
+    'session in seconds. Defaults to `upload_session_ttl` in config.py')
+def gc_uploads(max_age):
+  """
+  Deletes abandoned chunked upload sessions and stale temporary files of
+  the blob store.
+  """
+
+  if max_age is None:
+    max_age = config.upload_session_ttl
+  count = models.UploadSession.collect_garbage(max_age)
+  print('Deleted {} upload session(s).'.format(count))
+  count = blobstore.store.collect_garbage(max_age)
+  print('Deleted {} temporary file(s).'.format(count))
+
+
+@main.command('build-assets')
+def build_assets():
+  """
+  Compiles the SCSS files and creates fingerprinted static files.
+  """
+
+  manifest = require('./lib/assets').build()
+  print('Built {} static file(s).'.format(len(manifest)))
+
+
+@main.command('build-search-index')
+def build_search_index():
+  """
+  Rebuilds the full-text search index from the database.
+  """
+
+  search.rebuild()
+  print('Indexed {} package(s).'.format(len(search.index.docs)))
+
+
+@main.command('build-docs')
+def build_docs():
+  """
+  Renders the documentation pages into the cache directory.
+  """
+
+  count = docpages.build()
+  print('Rendered {} documentation page(s).'.format(count))
+
+
+@main.command('render-readmes')
+@click.option('--all', is_flag=True, help='Re-render all READMEs, not only '
+    'those rendered with a different set of Markdown extensions.')
+@click.option('-j', '--jobs', type=int, help='Number of worker processes.')
+def render_readmes(all, jobs):
+  """
+  Renders the stored READMEs to HTML.
+  """
+
+  def render(item):
+    id, readme = item
+    html, toc = markdown.render(readme) if readme else (None, None)
+    return id, html, toc
+
+  versions = models.PackageVersion.objects()
+  if not all:
+    versions = versions.filter(readme_render_version__ne=markdown.RENDER_VERSION)
+  count = 0
+  for id, html, toc in parallel.fork_map(render, versions.scalar('id', 'readme'), jobs):
+    models.PackageVersion.objects(id=id).update_one(set__readme_html=html,
+        set__readme_toc=toc, set__readme_render_version=markdown.RENDER_VERSION)
+    count += 1
+  print('Rendered {} README(s).'.format(count))
+
+
 @main.command()
 @click.option('-d', '--dry', is_flag=True)
-def migrate(dry):
+@click.option('-b', '--batch-size', type=int, default=1000,
+    help='Number of documents written per bulk operation.')
+@click.option('-j', '--jobs', type=int, default=1,
+    help='Number of worker processes for updating collections.')
+def migrate(dry, batch_size, jobs):
   """
-  Use after an update to upgrade the database.
+  Use after an update to upgrade the database. An interrupted migration
+  resumes where it stopped when this command is run again.
   """
 
+  def connect():
+    options = {k: v for k, v in config.mongodb.items() if k != 'db'}
+    return pymongo.MongoClient(**options)[config.mongodb['db']]
+
   migrate = require('./lib/migrate').Migration(models.db,
       models.CURRENT_REVISION, models.TARGET_REVISION,
-      os.path.join(__directory__, 'lib/migrations'), dry=dry)
+      os.path.join(__directory__, 'lib/migrations'), dry=dry,
+      revisions=models.MigrationRevision, batch_size=batch_size, jobs=jobs,
+      connect=connect)
   migrate.execute()
   if not dry:
     models.MigrationRevision.set(models.TARGET_REVISION)
+    # Indexes are not created automatically, see models.ensure_indexes().
+    for collection, name in models.ensure_indexes():
+      print('Created index "{}" on "{}".'.format(name, collection))
 
 
 if require.main == module:
@@ -24,6 +24,7 @@ import sys
 import config from './config'
 import models from './lib/models'
 import app from './lib/app'
+import suggest from './lib/suggest'
 import './lib/views/api'
 import './lib/views/docs'
 import './lib/views/registry'
@@ -41,6 +42,7 @@ def main():
     print('error: use the \'migrate\' command to upgrade the database.')
     sys.exit(1)
 
+  suggest.rebuild()
   app.run(host=config.host, port=config.port)
 
 